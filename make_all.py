@@ -16,96 +16,960 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>
 
 import argparse
+import asyncio
+import atexit
+import collections
+import contextlib
+import copy
 import enum
+import functools
+import hashlib
 import json
+import math
 import os
 import glob
+import queue
 import re
 import subprocess
 import shutil
+import shlex
+import signal
+import stat
+import tarfile
 import tempfile
+import threading
+import time
 import sys
+import urllib.request
+import xml.etree.ElementTree
+from concurrent.futures import ThreadPoolExecutor
 
 
-_cached_config = None
+# The API for driving builds from a long-running Python process. main() is a
+# command line wrapper around it. Failures raise BuildError instead of exiting.
+__all__ = [
+    'Action',
+    'ActionOptions',
+    'BatchRunner',
+    'BuildError',
+    'CommandError',
+    'Config',
+    'GarbageCollector',
+    'PathConf',
+    'PbuilderAction',
+    'Project',
+    'check_action_options',
+    'find_changed_projects',
+    'find_projects',
+    'get_all_pbuilder_paths',
+    'get_command_engine',
+    'run_action',
+    'run_pbuilder_action',
+    'update_pbuilders',
+]
+
+
+_default_config = None
+
+
+_out_lock = threading.Lock()
 
 
 def out(s):
     if isinstance(s, list):
         s = str(s)
-    sys.stdout.write(s + '\n')
-    sys.stdout.flush()
+    with _out_lock:
+        sys.stdout.write(s + '\n')
+        sys.stdout.flush()
+
+
+# The result of a command run by CommandEngine
+class CommandResult:
+
+    def __init__(self, cmd, cwd):
+        self.cmd = cmd
+        self.cwd = cwd
+        self.returncode = None
+        self.duration = 0.0
+        # The last lines of the output of the command
+        self.output_tail = []
+        # The whole output of the command if it was captured
+        self.output = None
+        self.timed_out = False
+        # The number of seconds without output or CPU activity after which
+        # the command was killed, if it was
+        self.stalled_after = None
+        # The memory limit of the command if it was killed for exceeding it
+        self.oom_killed_at = None
+        # Resource usage of the command and its descendants
+        self.user_time = 0.0
+        self.sys_time = 0.0
+        self.max_rss = 0
+        self.read_bytes = 0
+        self.write_bytes = 0
+
+    def succeeded(self):
+        return self.returncode == 0 and not self.timed_out and self.stalled_after is None
+
+
+# Raised when building a project fails. Records the project and the phase
+# that the failure happened in.
+class BuildError(Exception):
+
+    def __init__(self, msg):
+        super().__init__(msg)
+        self.project, self.phase, self.log_file = get_command_context()
+
+    def get_exit_code(self):
+        return 1
+
+
+class CommandError(BuildError):
+
+    def __init__(self, result):
+        self.result = result
+        if result.oom_killed_at is not None:
+            msg = 'Command \'{0}\' was killed for exceeding the memory limit of {1}'.format(
+                result.cmd, format_size(result.oom_killed_at))
+        elif result.stalled_after is not None:
+            msg = 'Command \'{0}\' made no progress for {1:.0f}s'.format(
+                result.cmd, result.stalled_after)
+            if result.output_tail:
+                msg += '. Last output:' + ''.join('\n  ' + line
+                                                  for line in result.output_tail[-5:])
+        elif result.timed_out:
+            msg = 'Command \'{0}\' timed out after {1:.0f}s'.format(result.cmd, result.duration)
+        else:
+            msg = 'Command \'{0}\' returned code {1}'.format(result.cmd, result.returncode)
+        super().__init__(msg)
 
+    def get_exit_code(self):
+        code = self.result.returncode
+        return code if code is not None and code > 0 else 1
 
-def sh(cmd, cwd, env=None):
-    out('DBG: Executing {0}'.format(cmd))
-    if isinstance(cmd, list):
-        code = subprocess.call(cmd, cwd=cwd, env=env)
-    else:
-        code = subprocess.call(cmd, shell=True, cwd=cwd, env=env)
-    if code != 0:
-        out('ERROR: Command \'{0}\' returned code {1}'.format(cmd, code))
-        sys.exit(code)
-    return code
 
+_command_context = threading.local()
 
-def get_config():
+
+# Sets the project, the phase and the log file that the commands run by the
+# current thread are attributed to. limits is a (stall_timeout, time_limit)
+# tuple and resources a dict as returned by get_config_resources() that are
+# applied to the commands, see CommandEngine.run(). stall_timeout applies to
+# each command, time_limit to all commands run within the block together.
+# The time limit of an enclosing block still applies.
+@contextlib.contextmanager
+def command_context(project, phase, log_file=None, limits=None, resources=None):
+    prev_context = getattr(_command_context, 'value', None)
+    stall_timeout, time_limit = limits or (None, None)
+    deadline = time.monotonic() + time_limit if time_limit is not None else None
+    if prev_context is not None and prev_context[3][1] is not None:
+        deadline = prev_context[3][1] if deadline is None else min(deadline, prev_context[3][1])
+    _command_context.value = (project, phase, log_file, (stall_timeout, deadline), resources)
+    try:
+        yield
+    finally:
+        _command_context.value = prev_context
+
+
+def get_command_context():
+    value = getattr(_command_context, 'value', None)
+    return value[:3] if value is not None else (None, None, None)
+
+
+# Returns the (stall_timeout, deadline) tuple of the command context. The
+# deadline is in terms of time.monotonic().
+def get_command_limits():
+    value = getattr(_command_context, 'value', None)
+    return value[3] if value is not None else (None, None)
+
+
+def get_command_resources():
+    value = getattr(_command_context, 'value', None)
+    return value[4] if value is not None else None
+
+
+# Returns whether commands can be run in transient systemd scopes of the user
+@functools.lru_cache(maxsize=None)
+def is_systemd_run_available():
+    if shutil.which('systemd-run') is None:
+        return False
+    return subprocess.run(['systemd-run', '--user', '--scope', '--quiet', '--', 'true'],
+                          stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL).returncode == 0
+
+
+# Returns the set of cgroup controllers (e.g. cpu, io and memory) that are
+# delegated to the systemd user manager and thus usable by its scopes
+@functools.lru_cache(maxsize=None)
+def get_systemd_user_controllers():
+    uid = os.getuid()
+    path = '/sys/fs/cgroup/user.slice/user-{0}.slice/user@{0}.service/cgroup.controllers'.format(
+        uid)
+    try:
+        with open(path) as f:
+            return frozenset(f.read().split())
+    except OSError:
+        return frozenset()
+
+
+# Converts a cgroup CPU weight (1-10000, 100 by default) to the nice value
+# with the same share of CPU time. A nice level is 1.25 times the weight of
+# the next one. Only lowering the priority is possible without privileges.
+def cpu_weight_to_nice(weight):
+    return max(0, min(19, round(math.log(100 / weight, 1.25))))
+
+
+# Converts a cgroup I/O weight (1-10000, 100 by default) to a level of the
+# best-effort I/O scheduling class (0-7, 4 by default)
+def io_weight_to_ionice_level(weight):
+    return max(0, min(7, 4 - round(math.log2(weight / 100))))
+
+
+# Returns a dict mapping the pid of each process to the fields of
+# /proc/<pid>/stat following the command name
+def read_process_table():
+    processes = {}
+    for fn in os.listdir('/proc'):
+        if not fn.isdigit():
+            continue
+        try:
+            with open(os.path.join('/proc', fn, 'stat')) as f:
+                stat = f.read()
+        except OSError:
+            continue
+        processes[int(fn)] = stat[stat.rfind(')') + 2:].split()
+    return processes
+
+
+# Returns the pids of the process and its descendants
+def get_process_tree(pid, processes=None):
+    if processes is None:
+        processes = read_process_table()
+    children = {}
+    for child_pid, fields in processes.items():
+        children.setdefault(int(fields[1]), []).append(child_pid)
+
+    pids = [pid]
+    for tree_pid in pids:
+        pids += children.get(tree_pid, [])
+    return pids
+
+
+# Returns the CPU time used so far by the process and its descendants,
+# including the descendants that have exited
+def get_process_tree_cpu_time(pid):
+    processes = read_process_table()
+    ticks = 0
+    for tree_pid in get_process_tree(pid, processes):
+        fields = processes.get(tree_pid, None)
+        if fields is not None:
+            # utime, stime, cutime and cstime
+            ticks += sum(int(field) for field in fields[11:15])
+    return ticks / os.sysconf('SC_CLK_TCK')
+
+
+# Sends the signal to the processes. Processes of other users, e.g. pbuilder
+# running via sudo, are signalled through sudo if it does not need a password.
+def signal_processes(pids, sig):
+    denied = []
+    for pid in pids:
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+        except PermissionError:
+            denied.append(pid)
+    if denied and shutil.which('sudo') is not None:
+        subprocess.run(['sudo', '-n', 'kill', '-s', signal.Signals(sig).name[3:], '--'] +
+                       [str(pid) for pid in denied],
+                       stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+
+
+# Runs commands as asyncio subprocesses on an event loop in a background
+# thread. Any number of threads may run commands at the same time. The output
+# of each command is printed line by line with a prefix identifying the
+# project and phase of the command and appended to the log file of the
+# project.
+class CommandEngine:
+
+    def __init__(self, tail_lines=20):
+        self.tail_lines = tail_lines
+        self.loop = None
+        self.lock = threading.Lock()
+        self.futures = set()
+        self.accounting = ResourceAccounting()
+        self.scope_count = 0
+
+    # Returns the command wrapped so that it runs with the given resource
+    # limits and the name of the systemd scope unit it runs in, if any.
+    # Commands run in a scope of their own if systemd-run is usable. Limits
+    # whose cgroup controller is not delegated to the user are approximated
+    # instead: the CPU and I/O weights with nice and ionice, while the memory
+    # limit is not enforced.
+    def isolate_command(self, cmd, resources):
+        if not isinstance(cmd, list):
+            cmd = ['sh', '-c', cmd]
+
+        controllers = frozenset()
+        if is_systemd_run_available():
+            controllers = get_systemd_user_controllers()
+
+        props = []
+        prefix = []
+        if resources.get('cpu_weight', None) is not None:
+            if 'cpu' in controllers:
+                props += ['-p', 'CPUWeight={0}'.format(resources['cpu_weight'])]
+            else:
+                prefix += ['nice', '-n', str(cpu_weight_to_nice(resources['cpu_weight']))]
+        if resources.get('memory_max', None) is not None and 'memory' in controllers:
+            props += ['-p', 'MemoryMax={0}'.format(parse_size(resources['memory_max']))]
+        if resources.get('io_weight', None) is not None:
+            if 'io' in controllers:
+                props += ['-p', 'IOWeight={0}'.format(resources['io_weight'])]
+            elif shutil.which('ionice') is not None:
+                prefix += ['ionice', '-c', '2', '-n',
+                           str(io_weight_to_ionice_level(resources['io_weight']))]
+
+        if not props:
+            return prefix + cmd, None
+        with self.lock:
+            self.scope_count += 1
+            unit = 'make_all-{0}-{1}.scope'.format(os.getpid(), self.scope_count)
+        return (['systemd-run', '--user', '--scope', '--quiet', '--unit=' + unit] +
+                props + ['--'] + prefix + cmd, unit)
+
+    # Returns whether the processes of the systemd scope unit have been
+    # killed for exceeding its memory limit. Forgets the unit afterwards.
+    @staticmethod
+    def was_scope_oom_killed(unit):
+        try:
+            output = subprocess.run(['systemctl', '--user', 'show', '--property=Result',
+                                     '--value', unit],
+                                    stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL).stdout.decode('utf-8')
+        except OSError:
+            return False
+        subprocess.run(['systemctl', '--user', 'reset-failed', unit],
+                       stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        return output.strip() == 'oom-kill'
+
+    def get_loop(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name='commands',
+                                 daemon=True).start()
+            return self.loop
+
+    # Returns a future that is resolved with the (status, rusage) tuple of the
+    # process once it exits. The process is reaped with wait4() by a thread of
+    # its own, as the asyncio child watchers do not report resource usage.
+    @staticmethod
+    def wait_process(loop, proc):
+        future = loop.create_future()
+
+        def set_result(exit_info):
+            if not future.done():
+                future.set_result(exit_info)
+
+        def wait():
+            _, status, rusage = os.wait4(proc.pid, 0)
+            loop.call_soon_threadsafe(set_result, (status, rusage))
+
+        threading.Thread(target=wait, name='wait-{0}'.format(proc.pid), daemon=True).start()
+        return future
+
+    # Kills the process and all its descendants. The processes that do not
+    # exit within grace_period after SIGTERM are killed with SIGKILL. If even
+    # that fails, e.g. as sudo needs a password to kill processes of another
+    # user, the process is given up on after another grace_period.
+    @staticmethod
+    async def terminate(proc, exit_future, grace_period=10):
+        if exit_future.done():
+            return
+        # The descendants are collected up front as they are reparented once
+        # their parent exits. Their start times tell them apart from later
+        # processes that reuse their pids.
+        processes = read_process_table()
+        start_times = {pid: processes[pid][19] for pid in get_process_tree(proc.pid, processes)
+                       if pid in processes}
+        await asyncio.to_thread(signal_processes, list(start_times), signal.SIGTERM)
+        try:
+            await asyncio.wait_for(asyncio.shield(exit_future), grace_period)
+        except asyncio.TimeoutError:
+            pass
+
+        processes = read_process_table()
+        pids = {pid for pid, start_time in start_times.items()
+                if pid in processes and processes[pid][19] == start_time}
+        # Once the process has been reaped, its pid may belong to another
+        # process
+        if not exit_future.done():
+            pids.update(get_process_tree(proc.pid, processes))
+        await asyncio.to_thread(signal_processes, sorted(pids), signal.SIGKILL)
+        try:
+            await asyncio.wait_for(asyncio.shield(exit_future), grace_period)
+        except asyncio.TimeoutError:
+            out('WARN: Could not kill process {0}, no longer waiting for it'.format(proc.pid))
+
+    # Returns once the process and its descendants have neither printed
+    # anything nor used any CPU time for stall_timeout seconds.
+    # get_last_output_time returns the time of the last output.
+    @staticmethod
+    async def watch_progress(proc, stall_timeout, get_last_output_time):
+        last_progress_time = time.monotonic()
+        cpu_time = 0.0
+        while True:
+            await asyncio.sleep(min(stall_timeout / 4, 10))
+            now = time.monotonic()
+            tree_cpu_time = await asyncio.to_thread(get_process_tree_cpu_time, proc.pid)
+            if tree_cpu_time > cpu_time:
+                cpu_time = tree_cpu_time
+                last_progress_time = now
+            last_progress_time = max(last_progress_time, get_last_output_time())
+            if now - last_progress_time >= stall_timeout:
+                return
+
+    async def run_async(self, cmd, cwd, env=None, timeout=None, prefix='', log_file=None,
+                        capture=False, stall_timeout=None):
+        result = CommandResult(cmd, cwd)
+        tail = collections.deque(maxlen=self.tail_lines)
+        captured = []
+        last_output_time = time.monotonic()
+
+        log_f = None
+        if log_file is not None:
+            os.makedirs(os.path.dirname(log_file), exist_ok=True)
+            log_f = open(log_file, 'a')
+            log_f.write('$ {0}\n'.format(cmd))
+
+        def emit(line):
+            nonlocal last_output_time
+            last_output_time = time.monotonic()
+            text = line.decode('utf-8', errors='replace').rstrip('\r')
+            tail.append(text)
+            if capture:
+                captured.append(text)
+            else:
+                out(prefix + text)
+            if log_f is not None:
+                log_f.write(text + '\n')
+
+        async def pump_output(stream):
+            pending = b''
+            while True:
+                if pending:
+                    # Show incomplete lines such as prompts if nothing else
+                    # arrives for a while
+                    try:
+                        chunk = await asyncio.wait_for(stream.read(1 << 16), 0.5)
+                    except asyncio.TimeoutError:
+                        emit(pending)
+                        pending = b''
+                        continue
+                else:
+                    chunk = await stream.read(1 << 16)
+                if not chunk:
+                    break
+                *lines, pending = (pending + chunk).split(b'\n')
+                for line in lines:
+                    emit(line)
+            if pending:
+                emit(pending)
+
+        start_time = time.monotonic()
+        loop = asyncio.get_running_loop()
+        proc = subprocess.Popen(cmd, shell=not isinstance(cmd, list), cwd=cwd, env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        exit_future = self.wait_process(loop, proc)
+        stream = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(stream), proc.stdout)
+
+        completion = asyncio.ensure_future(asyncio.gather(pump_output(stream),
+                                                          asyncio.shield(exit_future)))
+        tasks = [completion]
+        watchdog = None
+        if stall_timeout is not None:
+            watchdog = asyncio.ensure_future(self.watch_progress(
+                proc, stall_timeout, lambda: last_output_time))
+            tasks.append(watchdog)
+
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=timeout,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if completion in done:
+                completion.result()
+            else:
+                if watchdog in done:
+                    result.stalled_after = stall_timeout
+                else:
+                    result.timed_out = True
+                await self.terminate(proc, exit_future)
+        except asyncio.CancelledError:
+            await self.terminate(proc, exit_future)
+            raise
+        finally:
+            for task in tasks:
+                task.cancel()
+            transport.close()
+            result.duration = time.monotonic() - start_time
+            if exit_future.done():
+                status, rusage = exit_future.result()
+                result.returncode = os.waitstatus_to_exitcode(status)
+                # Keep Popen from waiting for the reaped process
+                proc.returncode = result.returncode
+                result.user_time = rusage.ru_utime
+                result.sys_time = rusage.ru_stime
+                result.max_rss = rusage.ru_maxrss * 1024
+                result.read_bytes = rusage.ru_inblock * 512
+                result.write_bytes = rusage.ru_oublock * 512
+            result.output_tail = list(tail)
+            if capture:
+                result.output = '\n'.join(captured)
+            if log_f is not None:
+                if result.stalled_after is not None:
+                    log_f.write('# killed after no output or CPU activity for {0:.0f}s\n'.format(
+                        result.stalled_after))
+                elif result.timed_out:
+                    log_f.write('# killed at the time limit after {0:.0f}s\n'.format(
+                        result.duration))
+                log_f.write('# exit code {0}, {1:.1f}s\n'.format(result.returncode,
+                                                                 result.duration))
+                log_f.close()
+        return result
+
+    # Runs a command and waits for it to complete. Raises CommandError if the
+    # command fails and check is set. If capture is set, the output is not
+    # printed but returned in CommandResult.output. The command is killed
+    # together with its descendants if it runs for longer than timeout or
+    # past the time limit of the command context, or if it neither prints anything
+    # nor uses CPU time for the stall timeout of the command context. The
+    # command runs with the resource limits of the command context.
+    def run(self, cmd, cwd, env=None, timeout=None, check=True, capture=False):
+        project, phase, log_file = get_command_context()
+        stall_timeout, deadline = get_command_limits()
+        if deadline is not None:
+            remaining = max(0.0, deadline - time.monotonic())
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        resources = get_command_resources()
+        run_cmd, unit = cmd, None
+        if resources is not None:
+            run_cmd, unit = self.isolate_command(cmd, resources)
+        prefix = ''
+        if project is not None:
+            prefix = '[{0}] '.format(':'.join(p for p in [project, phase] if p is not None))
+
+        if not capture:
+            out('{0}DBG: Executing {1}'.format(prefix, cmd))
+        future = asyncio.run_coroutine_threadsafe(
+            self.run_async(run_cmd, cwd, env=env, timeout=timeout, prefix=prefix,
+                           log_file=None if capture else log_file, capture=capture,
+                           stall_timeout=stall_timeout),
+            self.get_loop())
+        with self.lock:
+            self.futures.add(future)
+        try:
+            result = future.result()
+        except BaseException:
+            # E.g. KeyboardInterrupt. Kill the command
+            future.cancel()
+            raise
+        finally:
+            with self.lock:
+                self.futures.discard(future)
+
+        result.cmd = cmd
+        if unit is not None and result.returncode != 0 and \
+                resources.get('memory_max', None) is not None and self.was_scope_oom_killed(unit):
+            result.oom_killed_at = parse_size(resources['memory_max'])
+            out('{0}Killed for exceeding the memory limit of {1}'.format(
+                prefix, format_size(result.oom_killed_at)))
+
+        if project is not None:
+            self.accounting.record(project, phase, result)
+        if check and not result.succeeded():
+            raise CommandError(result)
+        return result
+
+    # Kills all running commands
+    def cancel_all(self):
+        with self.lock:
+            futures = list(self.futures)
+        for future in futures:
+            future.cancel()
+
+
+# Accumulates the resource usage of commands per project and phase
+class ResourceAccounting:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Maps (project, phase) to a dict of totals
+        self.usage = collections.OrderedDict()
+
+    def record(self, project, phase, result):
+        with self.lock:
+            usage = self.usage.setdefault((project, phase), {
+                'commands': 0, 'wall_time': 0.0, 'cpu_time': 0.0, 'max_rss': 0,
+                'read_bytes': 0, 'write_bytes': 0,
+            })
+            usage['commands'] += 1
+            usage['wall_time'] += result.duration
+            usage['cpu_time'] += result.user_time + result.sys_time
+            usage['max_rss'] = max(usage['max_rss'], result.max_rss)
+            usage['read_bytes'] += result.read_bytes
+            usage['write_bytes'] += result.write_bytes
+
+    def has_usage(self):
+        with self.lock:
+            return len(self.usage) > 0
+
+    # Prints a table of the resource usage. The Cores column is the CPU time
+    # divided by the wall time, i.e. the average number of busy cores. Phases
+    # that keep fewer cores than num_cores busy and have a small Max RSS can
+    # run in parallel with other builds.
+    def print_summary(self):
+        rows = [('Project', 'Phase', 'Cmds', 'Wall', 'CPU', 'Cores', 'Max RSS', 'Read',
+                 'Written')]
+        with self.lock:
+            items = list(self.usage.items())
+        for (project, phase), usage in items:
+            wall_time = usage['wall_time']
+            cores = usage['cpu_time'] / wall_time if wall_time > 0 else 0.0
+            rows.append((project, phase or '', str(usage['commands']),
+                         '{0:.1f}s'.format(wall_time),
+                         '{0:.1f}s'.format(usage['cpu_time']),
+                         '{0:.1f}'.format(cores),
+                         format_size(usage['max_rss']),
+                         format_size(usage['read_bytes']),
+                         format_size(usage['write_bytes'])))
+
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        out('')
+        out('Resource usage:')
+        for row in rows:
+            cells = [row[0].ljust(widths[0]), row[1].ljust(widths[1])]
+            cells += [cell.rjust(width) for cell, width in zip(row[2:], widths[2:])]
+            out('  '.join(cells))
+
+
+_command_engine = None
+
+
+def get_command_engine():
+    global _command_engine
+    if _command_engine is None:
+        _command_engine = CommandEngine()
+    return _command_engine
+
+
+# Runs a command. Raises CommandError on failure. Returns a CommandResult.
+def sh(cmd, cwd, env=None, timeout=None):
+    return get_command_engine().run(cmd, cwd, env=env, timeout=timeout)
+
+
+# Decorator for Project methods that attributes the commands run by the
+# method to the given phase of the project
+def project_phase(phase):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.phase_context(phase):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Config:
     ''' Supported keys:
 
         num_cores (int): The number of cores to use when building
 
         debian_sign_key (str): The ID of the key to use for signing the packages.
-            If missing or None, the packages won't be signed.
-    '''
-    global _cached_config
-    if _cached_config is not None:
-        return _cached_config
+            If missing or None, the packages won't be signed. When building
+            through run_action(), the packages are built unsigned and signed
+            with debsign all at once at the end of the run.
 
-    config_path = os.path.join(os.environ['HOME'], '.config', 'p12build.json')
-    if not os.path.exists(config_path):
-        out("Config ~/.config/p12build.json does not exist, using defaults")
-        return {}
-    with open(config_path) as config_f:
-        _cached_config = json.load(config_f)
-        return _cached_config
+        artifact_cache (bool): Whether to reuse the packages of an earlier build
+            with identical inputs. Defaults to True.
+
+        gc_keep_versions (int): The number of most recent versions of each
+            project and distribution to keep in the packaging build directories.
+
+        gc_max_size (int or str): The maximum total size of the packaging build
+            directories and the artifact cache, e.g. 50G.
+
+        gc_max_age_days (float): Packaging build directories and artifact cache
+            entries older than this are removed.
+
+        If any of the gc_* keys are set, garbage collection runs in the
+        background during builds. The most recent version of each project and
+        distribution is always kept.
+
+        prefetch_build_depends (bool): Whether to download the build
+            dependencies of all projects into the pbuilder apt cache in the
+            background when using pbuilder. Defaults to True.
 
+        prefetch_jobs (int): The number of concurrent downloads when
+            prefetching build dependencies. Defaults to 8.
+
+        tmpfs_path (str): A directory on a tmpfs (e.g. /dev/shm/p12build). If
+            set, packaging build directories, pbuilder build places and fresh
+            build directories are placed there as long as they fit into
+            tmpfs_budget. Final packages are copied to the regular
+            packaging build directories.
+
+        tmpfs_budget (int or str): The maximum total size of the data under
+            tmpfs_path, e.g. 16G. Defaults to the free space of the tmpfs.
+
+        tmpfs_size_factor (float): The estimated size of the build of a project
+            relative to the size of its source tree. Defaults to 4.
+
+        fast_deb_compressor (str): The compressor of .deb packages when
+            --fast-compression is used, e.g. gzip or zstd. Defaults to gzip.
+
+        fast_compression_level (int): The compression level of orig tarballs
+            and .deb packages when --fast-compression is used. Defaults to 1.
+
+        pbuilder_max_age_days (float): pbuilder environments that have not been
+            updated for longer than this are updated before a build that uses
+            them. If missing, environments are only updated on request.
+
+        pbuilder_update_jobs (int): The number of pbuilder environments to
+            update at a time. Defaults to 2.
+
+        stall_timeout (float or dict): Commands that neither print anything
+            nor use any CPU time, including their child processes, for this
+            many seconds are killed along with their child processes. Either a
+            number or a dict mapping phase names (e.g. check or binary) to
+            numbers, with the 'default' entry applying to the other phases.
+            Disabled by default.
+
+        time_limit (float or dict): The time in seconds that all commands of a
+            phase may take together. The command running when the limit is
+            reached is killed along with its child processes. Same format as
+            stall_timeout. Disabled by default.
+
+        cpu_weight (int): The CPU weight (1-10000, 100 by default) of the
+            commands building the project.
+
+        memory_max (int or str): The maximum memory usage of each command
+            building the project including its child processes, e.g. 8G.
+
+        io_weight (int): The I/O weight (1-10000, 100 by default) of the
+            commands building the project.
+
+        If any of cpu_weight, memory_max and io_weight are set, each command
+        runs in a systemd scope of its own with these limits. Limits whose
+        cgroup controller (cpu, memory or io) is not delegated to the systemd
+        user manager, or all of them if systemd-run can't be used, fall back
+        individually: the weights are approximated with nice and ionice and
+        memory_max has no effect.
+    '''
 
-def get_config_key(project, key, default):
-    config = get_config()
-    if 'projects' in config and project in config['projects']:
-        config_project = config['projects'][project]
+    def __init__(self, values=None):
+        self.values = values if values is not None else {}
+
+    # Loads the configuration from the given JSON file, by default
+    # ~/.config/p12build.json. A missing file results in the defaults.
+    @classmethod
+    def load(cls, path=None):
+        if path is None:
+            path = os.path.join(os.environ['HOME'], '.config', 'p12build.json')
+        if not os.path.exists(path):
+            out("Config {0} does not exist, using defaults".format(path))
+            return cls()
+        with open(path) as config_f:
+            return cls(json.load(config_f))
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    # Returns the value of a key for a project. Values in the projects
+    # section override the global ones.
+    def get_project_key(self, project, key, default):
+        config_project = self.values.get('projects', {}).get(project, {})
         if key in config_project:
             return config_project[key]
+        return self.values.get(key, default)
 
-    return config.get(key, default)
 
+# Returns the configuration loaded from ~/.config/p12build.json, which is used
+# unless a Config is given explicitly
+def get_config():
+    global _default_config
+    if _default_config is None:
+        _default_config = Config.load()
+    return _default_config
+
+
+def get_config_key(config, project, key, default):
+    return config.get_project_key(project, key, default)
+
+
+# Returns the (stall_timeout, time_limit) tuple for the commands of the given
+# phase of the project. Phases of a single architecture such as binary-amd64
+# fall back to the limits of the phase without the architecture.
+def get_config_watchdog_limits(config, project, phase):
+    limits = []
+    for key in ['stall_timeout', 'time_limit']:
+        value = get_config_key(config, project, key, None)
+        if isinstance(value, dict):
+            value = value.get(phase, value.get(phase.split('-')[0], value.get('default', None)))
+        limits.append(value)
+    return tuple(limits)
+
+
+# Returns the resource limits of the commands of the project as a dict with
+# the cpu_weight, memory_max and io_weight keys or None if none are configured
+def get_config_resources(config, project):
+    resources = {key: get_config_key(config, project, key, None)
+                 for key in ['cpu_weight', 'memory_max', 'io_weight']}
+    if all(value is None for value in resources.values()):
+        return None
+    return resources
+
+
+def get_config_cpu_cores(config, project):
+    return get_config_key(config, project, 'num_cores', 1)
+
+
+def get_config_debian_sign_key(config, project):
+    return get_config_key(config, project, 'debian_sign_key', None)
+
+
+def get_config_dist_method(config, project):
+    return get_config_key(config, project, 'dist_method', None)
+
+
+def get_config_embedded_packaging_dir(config, project):
+    return get_config_key(config, project, 'embedded_packaging_dir', None)
+
+
+def get_config_artifact_cache(config, project):
+    return get_config_key(config, project, 'artifact_cache', True)
+
+
+def get_config_prefetch_build_depends(config, project):
+    return get_config_key(config, project, 'prefetch_build_depends', True)
 
-def get_config_cpu_cores(project):
-    return get_config_key(project, 'num_cores', 1)
 
+def get_config_fast_deb_compressor(config, project):
+    return get_config_key(config, project, 'fast_deb_compressor', 'gzip')
 
-def get_config_debian_sign_key(project):
-    return get_config_key(project, 'debian_sign_key', None)
 
+def get_config_fast_compression_level(config, project):
+    return get_config_key(config, project, 'fast_compression_level', 1)
 
-def get_config_dist_method(project):
-    return get_config_key(project, 'dist_method', None)
 
+def parse_size(size):
+    if size is None or isinstance(size, int):
+        return size
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', str(size), re.I)
+    if not m:
+        raise BuildError('could not parse size \'{0}\''.format(size))
+    multiplier = 1024 ** ' KMGT'.index(m.group(2).upper() or ' ')
+    return int(float(m.group(1)) * multiplier)
 
-def get_config_embedded_packaging_dir(project):
-    return get_config_key(project, 'embedded_packaging_dir', None)
 
+def format_size(size):
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024:
+            return '{0:.1f} {1}'.format(size, unit)
+        size /= 1024
+    return '{0:.1f} TiB'.format(size)
 
+
+# The results of the probes of the host are reused by all builds of the
+# process
+@functools.lru_cache(maxsize=None)
 def resolve_architecture(arch):
     if arch is None:
         return subprocess.check_output(['dpkg', '--print-architecture']).decode('utf-8').strip()
     return arch
 
 
+@functools.lru_cache(maxsize=None)
 def get_dist_suite():
     return subprocess.check_output(['lsb_release', '-sc']).decode('utf-8').strip()
 
 
+# Returns the version of ctest as a tuple of integers
+@functools.lru_cache(maxsize=None)
+def get_ctest_version():
+    output = subprocess.check_output(['ctest', '--version']).decode('utf-8')
+    m = re.search(r'(\d+)\.(\d+)', output)
+    if m is None:
+        return (0, 0)
+    return (int(m.group(1)), int(m.group(2)))
+
+
+# Returns the list of tests in a JUnit XML report. Each test is a dict with
+# name, status and duration keys
+def parse_junit_report(path):
+    tests = []
+    root = xml.etree.ElementTree.parse(path).getroot()
+    for case in root.iter('testcase'):
+        if case.find('failure') is not None or case.find('error') is not None:
+            status = 'failed'
+        elif case.find('skipped') is not None or \
+                case.get('status') in ('notrun', 'disabled'):
+            status = 'skipped'
+        else:
+            status = 'passed'
+        tests.append({'name': case.get('name'),
+                      'status': status,
+                      'duration': float(case.get('time', 0))})
+    return tests
+
+
+# Returns the list of tests in the Test.xml file that ctest -T Test writes, in
+# the same format as parse_junit_report()
+def parse_ctest_xml_report(path):
+    statuses = {
+        'passed': 'passed',
+        'notrun': 'skipped',
+        'disabled': 'skipped',
+    }
+    tests = []
+    root = xml.etree.ElementTree.parse(path).getroot()
+    for test in root.iter('Test'):
+        # The TestList element lists the tests without results
+        if test.get('Status') is None:
+            continue
+        duration = 0.0
+        for measurement in test.iter('NamedMeasurement'):
+            if measurement.get('name') == 'Execution Time':
+                duration = float(measurement.findtext('Value', '0'))
+        tests.append({'name': test.findtext('Name'),
+                      'status': statuses.get(test.get('Status'), 'failed'),
+                      'duration': duration})
+    return tests
+
+
+# Returns the list of tests in a meson testlog.json file in the same format as
+# parse_junit_report(). The file contains a JSON object per line.
+def parse_meson_testlog(path):
+    statuses = {
+        'OK': 'passed',
+        'EXPECTEDFAIL': 'passed',
+        'SKIP': 'skipped',
+    }
+    tests = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            tests.append({'name': entry['name'],
+                          'status': statuses.get(entry.get('result'), 'failed'),
+                          'duration': float(entry.get('duration', 0))})
+    return tests
+
+
 # Returns tuple of release URL and components
 def get_props_for_dist_suite(suite):
     ubuntu_old_suites = [
@@ -172,11 +1036,186 @@ def get_props_for_dist_suite(suite):
         )
 
 
+# Allocates working directories on a tmpfs within a size budget. Callers
+# reserve the estimated size of a directory before creating it and fall back
+# to the regular disk if the reservation fails.
+class TmpfsStaging:
+
+    def __init__(self, path, budget=None):
+        self.path = path
+        self.budget = parse_size(budget)
+        self.used_size = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        path = config.get('tmpfs_path', None)
+        if path is None:
+            return None
+        return cls(os.path.expanduser(path), config.get('tmpfs_budget', None))
+
+    def get_path(self, *parts):
+        return os.path.join(self.path, *parts)
+
+    def reserve(self, size):
+        with self.lock:
+            if self.used_size is None:
+                os.makedirs(self.path, exist_ok=True)
+                if self.budget is None:
+                    # Whatever is already there is accounted for by the
+                    # file system
+                    st = os.statvfs(self.path)
+                    self.budget = st.f_bavail * st.f_frsize
+                    self.used_size = 0
+                else:
+                    self.used_size = get_tree_size(self.path, set())
+
+            if self.used_size + size > self.budget:
+                return False
+            self.used_size += size
+            return True
+
+    def release(self, size):
+        with self.lock:
+            self.used_size -= size
+
+    # Replaces a reservation of reserved_size bytes with the space that path
+    # actually takes. Returns the latter.
+    def settle(self, reserved_size, path):
+        size = get_tree_size(path, set()) if os.path.isdir(path) else 0
+        with self.lock:
+            self.used_size += size - reserved_size
+        return size
+
+
+# Removes directory trees in the background. Each tree is atomically renamed
+# into a trash area on the same file system, so the caller can reuse the path
+# at once, and a single thread deletes the trash at low I/O priority. Pending
+# deletions are finished before the process exits.
+class Trash:
+
+    def __init__(self, area_paths):
+        self.area_paths = area_paths
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.counter = 0
+
+    # Returns the trash area on the file system of path or None if there is
+    # no such area
+    def get_area_path(self, path):
+        dev = os.stat(os.path.dirname(os.path.abspath(path))).st_dev
+        for area_path in self.area_paths:
+            try:
+                os.makedirs(area_path, exist_ok=True)
+                if os.stat(area_path).st_dev == dev:
+                    return area_path
+            except OSError:
+                pass
+        return None
+
+    def remove(self, path):
+        if not os.path.lexists(path):
+            return
+        area_path = self.get_area_path(path)
+        if area_path is None:
+            shutil.rmtree(path)
+            return
+
+        with self.lock:
+            self.start()
+            self.counter += 1
+            trash_path = os.path.join(area_path, '{0}-{1}-{2}'.format(
+                os.path.basename(path), os.getpid(), self.counter))
+            try:
+                os.rename(path, trash_path)
+            except OSError:
+                # E.g. EXDEV across bind mounts of the same file system
+                trash_path = None
+        if trash_path is None:
+            shutil.rmtree(path)
+            return
+        self.queue.put(trash_path)
+
+    def start(self):
+        if self.thread is not None:
+            return
+
+        # Pick up the trash left behind by processes that have exited before
+        # they could delete it
+        for area_path in self.area_paths:
+            if not os.path.isdir(area_path):
+                continue
+            for fn in os.listdir(area_path):
+                m = re.match(r'.*-(\d+)-\d+$', fn)
+                if m is None or not is_pid_alive(int(m.group(1))):
+                    self.queue.put(os.path.join(area_path, fn))
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.join)
+
+    def run(self):
+        while True:
+            path = self.queue.get()
+            if path is None:
+                return
+            self.delete_tree(path)
+
+    @staticmethod
+    def delete_tree(path):
+        if shutil.which('ionice') is not None:
+            cmd = ['ionice', '-c', '2', '-n', '7', 'nice', '-n', '19', 'rm', '-rf', '--', path]
+            if subprocess.run(cmd, stdin=subprocess.DEVNULL).returncode == 0:
+                return
+        shutil.rmtree(path, ignore_errors=True)
+
+    # Waits until all trees passed to remove() have been deleted
+    def join(self):
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+        if thread is None:
+            return
+        if not self.queue.empty():
+            out('Waiting for removal of {0} build trees'.format(self.queue.qsize()))
+        self.queue.put(None)
+        thread.join()
+
+
+def is_pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
 # directory layout configuration
 class PathConf:
 
-    def __init__(self):
+    def __init__(self, config=None):
+        self.config = config if config is not None else get_config()
         self.set_pbuilder_dist(get_dist_suite(), None)
+        self.tmpfs_staging = TmpfsStaging.from_config(self.config)
+        trash_area_paths = [os.path.join(self.root_path, 'trash')]
+        if self.tmpfs_staging is not None:
+            trash_area_paths.append(self.tmpfs_staging.get_path('trash'))
+        self.trash = Trash(trash_area_paths)
+        # The LocalRepository made available to pbuilder builds, if any
+        self.local_repo = None
+        # The SigningQueue of the current run, if any
+        self.signing_queue = None
+        # The GarbageCollector running concurrently with the current run, if
+        # any
+        self.gc = None
+
+    # Selects the directories of the projects for pristine builds
+    def set_pristine(self):
+        self.project_dirs = self.deb_project_dirs
+        self.build_pkg_path = self.build_deb_pkg_path
 
     def set_pbuilder_dist(self, dist, arch):
         if '-' in dist:
@@ -203,6 +1242,11 @@ class PathConf:
                                                 'build_pbuilder')
         self.pkg_path = os.path.join(self.root_path, "checkouts_packaging")
         self.log_path = os.path.join(self.root_path, "log")
+        self.artifact_cache_path = os.path.join(self.root_path, 'build_cache', 'artifacts')
+        self.checkpoint_path = os.path.join(self.root_path, 'build_cache', 'checkpoints')
+        self.build_records_path = os.path.join(self.root_path, 'build_cache', 'builds.json')
+        self.orig_cache_path = os.path.join(self.root_path, 'build_cache', 'orig')
+        self.pristine_tree_path = os.path.join(self.root_path, 'build_cache', 'pristine_trees')
 
         project_fns = ['checkouts', 'local', 'mods']
 
@@ -231,9 +1275,22 @@ class PathConf:
         self.pbuilder_tgz_path = \
             os.path.join(self.build_pbuilder_path, "base_tgzs")
 
-        self.pbuilder_tgz = \
-            os.path.join(self.pbuilder_tgz_path,
-                         'base_' + self.dist_suite + '-' + self.arch + '.tgz')
+        self.pbuilder_tgz = self.get_pbuilder_tgz(self.arch)
+        self.pbuilder_aptstate_path = \
+            os.path.join(self.build_pbuilder_path, "aptstate",
+                         self.dist_suite + '-' + self.arch)
+
+    # Returns a copy of the configuration with the pbuilder environment of the
+    # given distribution suite and architecture selected
+    def for_pbuilder_dist(self, dist, arch):
+        paths = copy.copy(self)
+        paths.set_pbuilder_dist(dist, arch)
+        return paths
+
+    # Returns the path of the pbuilder base tarball for the given architecture
+    def get_pbuilder_tgz(self, arch):
+        return os.path.join(self.pbuilder_tgz_path,
+                            'base_' + self.dist_suite + '-' + arch + '.tgz')
 
 
 def get_dir_mtime(path):
@@ -248,12 +1305,620 @@ def get_dir_mtime(path):
     return max_mtime
 
 
+def get_file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# Returns a digest of the contents of the directory tree at path. Git metadata
+# is ignored
+def get_dir_fingerprint(path):
+    h = hashlib.sha256()
+    for dirname, subdirs, files in os.walk(path):
+        subdirs.sort()
+        for subdir in list(subdirs):
+            subdir_path = os.path.join(dirname, subdir)
+            if subdir == '.git':
+                subdirs.remove(subdir)
+            elif os.path.islink(subdir_path):
+                rel_path = os.path.relpath(subdir_path, path)
+                h.update('L {0} {1}\n'.format(rel_path, os.readlink(subdir_path)).encode())
+
+        for fname in sorted(files):
+            file_path = os.path.join(dirname, fname)
+            rel_path = os.path.relpath(file_path, path)
+            if os.path.islink(file_path):
+                h.update('L {0} {1}\n'.format(rel_path, os.readlink(file_path)).encode())
+                continue
+            kind = 'X' if os.access(file_path, os.X_OK) else 'F'
+            h.update('{0} {1} {2}\n'.format(kind, rel_path,
+                                            get_file_digest(file_path)).encode())
+    return h.hexdigest()
+
+
+# Returns a digest of the committed state of a git repository including its
+# submodules. Refs that do not exist are ignored.
+def get_git_fingerprint(path, refs=('HEAD^{tree}',)):
+    h = hashlib.sha256()
+    engine = get_command_engine()
+    for ref in refs:
+        r = engine.run(['git', 'rev-parse', '--verify', '-q', ref], cwd=path,
+                       check=False, capture=True)
+        h.update('{0} {1}\n'.format(ref, r.output.strip()).encode())
+
+    if os.path.isfile(os.path.join(path, '.gitmodules')):
+        r = engine.run(['git', 'submodule', 'status', '--recursive'], cwd=path, capture=True)
+        h.update(r.output.encode())
+    return h.hexdigest()
+
+
+# Merges the given tar archives into a tar archive at dest_path whose bytes
+# only depend on the names, types and contents of the entries. The entries are
+# sorted by name, have the given mtime, belong to root and have either 0755 or
+# 0644 permissions. Entries of later archives replace those of earlier ones.
+def write_reproducible_tar(source_paths, dest_path, mtime):
+    with contextlib.ExitStack() as stack:
+        members = {}
+        for source_path in source_paths:
+            source = stack.enter_context(tarfile.open(source_path))
+            for member in source.getmembers():
+                members[member.name.rstrip('/')] = (source, member)
+
+        with tarfile.open(dest_path, 'w', format=tarfile.GNU_FORMAT) as dest:
+            for name in sorted(members):
+                source, member = members[name]
+                info = copy.copy(member)
+                info.name = name
+                info.mtime = mtime
+                info.uid = info.gid = 0
+                info.uname = info.gname = 'root'
+                info.pax_headers = {}
+                if info.issym():
+                    info.mode = 0o777
+                elif info.isdir() or info.mode & 0o111:
+                    info.mode = 0o755
+                else:
+                    info.mode = 0o644
+                dest.addfile(info, source.extractfile(member) if info.isfile() else None)
+
+
+# Content-addressed storage of the outputs of successful package builds. Each
+# entry is a directory named after the digest of all inputs of the build.
+# Files are shared with the build directories through hardlinks.
+class ArtifactCache:
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def compute_key(inputs):
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def is_artifact(fn):
+        return re.search(r'\.(deb|udeb|ddeb|changes|dsc|buildinfo)$', fn) or \
+            re.search(r'\.tar\.(gz|xz|bz2|lzma|zst)$', fn)
+
+    @staticmethod
+    def link_or_copy(src, dst):
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+    def restore(self, key, dest_path):
+        entry_path = os.path.join(self.path, key)
+        index_path = os.path.join(entry_path, 'index.json')
+        if not os.path.isfile(index_path):
+            return False
+
+        with open(index_path) as f:
+            files = json.load(f)['files']
+
+        if os.path.isdir(dest_path):
+            shutil.rmtree(dest_path)
+        os.makedirs(dest_path)
+        for fn in files:
+            try:
+                self.link_or_copy(os.path.join(entry_path, fn), os.path.join(dest_path, fn))
+            except FileNotFoundError:
+                # The entry has been garbage collected in the meantime
+                shutil.rmtree(dest_path)
+                return False
+        return True
+
+    def store(self, key, src_path, proj_name):
+        entry_path = os.path.join(self.path, key)
+        if os.path.isdir(entry_path):
+            return
+
+        files = sorted(fn for fn in os.listdir(src_path)
+                       if self.is_artifact(fn) and os.path.isfile(os.path.join(src_path, fn)))
+        if not files:
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(prefix=key + '.', dir=self.path)
+        for fn in files:
+            self.link_or_copy(os.path.join(src_path, fn), os.path.join(tmp_path, fn))
+        with open(os.path.join(tmp_path, 'index.json'), 'w') as f:
+            json.dump({'project': proj_name, 'files': files}, f, indent=2)
+
+        try:
+            os.rename(tmp_path, entry_path)
+        except OSError:
+            # Another build has stored the same entry in the meantime
+            shutil.rmtree(tmp_path)
+
+
+# Checkpoints of the phases (see PackagePhase) of a package build. Each
+# checkpoint records the fingerprint of the inputs of its phase, the files that
+# later phases need and the state of the build after the phase. The
+# fingerprint of a phase includes the fingerprint of the previous phase, so a
+# checkpoint is only valid if all earlier phases had identical inputs too.
+class Checkpoints:
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    # Returns a dict mapping each phase to its fingerprint. phase_inputs is a
+    # list of (phase, inputs) tuples in the order of the phases
+    @staticmethod
+    def compute_fingerprints(phase_inputs):
+        fingerprints = {}
+        fingerprint = None
+        for phase, inputs in phase_inputs:
+            fingerprint = ArtifactCache.compute_key({'previous': fingerprint,
+                                                     'phase': phase.name,
+                                                     'inputs': inputs})
+            fingerprints[phase] = fingerprint
+        return fingerprints
+
+    # Returns the last phase whose checkpoint is valid and whose outputs still
+    # exist along with the recorded state, or (None, None)
+    def find_resume_point(self, fingerprints):
+        for phase in sorted(fingerprints, key=lambda phase: phase.value, reverse=True):
+            entry = self.entries.get(phase.name, None)
+            if entry is None or entry['fingerprint'] != fingerprints[phase]:
+                continue
+            if all(os.path.exists(path) for path in entry['outputs']):
+                return phase, entry['state']
+        return None, None
+
+    # Records the completion of a phase. The checkpoints of the later phases
+    # are dropped because their outputs are going to be overwritten
+    def record(self, phase, fingerprint, outputs, state):
+        self.entries = {name: entry for name, entry in self.entries.items()
+                        if name in PackagePhase.__members__ and
+                        PackagePhase[name].value < phase.value}
+        self.entries[phase.name] = {
+            'fingerprint': fingerprint,
+            'outputs': outputs,
+            'state': state,
+        }
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+# The fingerprints of the inputs of the projects at their last successful
+# build, keyed by the path of the project relative to the root directory
+class BuildRecords:
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def is_changed(self, key, fingerprint):
+        return self.entries.get(key, None) != fingerprint
+
+    def record(self, key, fingerprint):
+        with self.lock:
+            self.entries[key] = fingerprint
+
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.entries, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
+
+# Returns the disk usage of the directory tree at path. Files whose inodes are
+# in seen_inodes are not counted again.
+def get_tree_size(path, seen_inodes):
+    size = 0
+    for dirname, subdirs, files in os.walk(path):
+        for fname in subdirs + files:
+            try:
+                st = os.lstat(os.path.join(dirname, fname))
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in seen_inodes:
+                continue
+            seen_inodes.add((st.st_dev, st.st_ino))
+            size += st.st_blocks * 512
+    return size
+
+
+# Counts the links to the inodes within a set of directory trees to compute
+# the disk space that removing all of them reclaims. Files that have further
+# hard links outside of the set stay allocated and are not counted.
+class TreeLinks:
+
+    def __init__(self):
+        # Maps (device, inode) to [size, link count, links within the set]
+        self.inodes = {}
+        self.reclaimable_size = 0
+
+    # Returns a list of (device, inode, size, link count) tuples of the files
+    # in the directory tree at path
+    @staticmethod
+    def scan(path):
+        inodes = []
+        for dirname, subdirs, files in os.walk(path):
+            for fname in subdirs + files:
+                try:
+                    st = os.lstat(os.path.join(dirname, fname))
+                except OSError:
+                    continue
+                # Each directory is seen once, regardless of its link count
+                nlink = 1 if stat.S_ISDIR(st.st_mode) else st.st_nlink
+                inodes.append((st.st_dev, st.st_ino, st.st_blocks * 512, nlink))
+        return inodes
+
+    # Adds a tree scanned by scan() to the set
+    def add(self, inodes):
+        for dev, ino, size, nlink in inodes:
+            entry = self.inodes.setdefault((dev, ino), [size, nlink, 0])
+            entry[2] += 1
+            if entry[2] == entry[1]:
+                self.reclaimable_size += entry[0]
+
+
+# Removes old packaging build directories and artifact cache entries
+# according to retention policies. Packaging build directories are grouped by
+# project and distribution. Within a group, directories of the same version
+# are kept or removed together.
+#
+# Paths that are being built during the current run are protected via
+# protect_path() so that the collector can run concurrently with builds.
+class GarbageCollector:
+
+    def __init__(self, paths, keep_versions=None, max_size=None, max_age_days=None):
+        self.roots = sorted({paths.build_pkg_path, paths.build_deb_pkg_path})
+        self.cache_paths = [paths.artifact_cache_path, paths.orig_cache_path]
+        self.keep_versions = keep_versions
+        self.max_size = parse_size(max_size)
+        self.max_age_days = max_age_days
+        self.removed_count = 0
+        self.reclaimed_size = 0
+        self.thread = None
+        self.lock = threading.Lock()
+        self.protected_paths = set()
+
+    @classmethod
+    def from_config(cls, paths):
+        config = paths.config
+        return cls(paths,
+                   keep_versions=config.get('gc_keep_versions', None),
+                   max_size=config.get('gc_max_size', None),
+                   max_age_days=config.get('gc_max_age_days', None))
+
+    def has_policies(self):
+        return (self.keep_versions is not None or self.max_size is not None or
+                self.max_age_days is not None)
+
+    def protect_path(self, path):
+        with self.lock:
+            self.protected_paths.add(os.path.abspath(path))
+
+    @staticmethod
+    def parse_pkgver_dirname(dirname):
+        # See Project.get_pkgver_dirname(). Pristine builds use the version
+        # and version_source directories
+        parts = dirname.split('_')
+        dist = parts[1] if len(parts) > 1 and parts[1] != 'source' else ''
+        return parts[0], dist
+
+    # Returns a list of (group, version, path, mtime) tuples. group is None for
+    # entries that are not subject to the version retention policy.
+    def collect_entries(self):
+        entries = []
+        for root in self.roots:
+            if not os.path.isdir(root):
+                continue
+            for proj_name in sorted(os.listdir(root)):
+                proj_path = os.path.join(root, proj_name)
+                if not os.path.isdir(proj_path):
+                    continue
+                for dirname in os.listdir(proj_path):
+                    path = os.path.join(proj_path, dirname)
+                    if not os.path.isdir(path) or os.path.islink(path):
+                        continue
+                    version, dist = self.parse_pkgver_dirname(dirname)
+                    entries.append(((proj_path, dist), version, path, os.path.getmtime(path)))
+
+        for cache_path in self.cache_paths:
+            if not os.path.isdir(cache_path):
+                continue
+            for key in os.listdir(cache_path):
+                path = os.path.join(cache_path, key)
+                if os.path.isdir(path):
+                    entries.append((None, None, path, os.path.getmtime(path)))
+        return entries
+
+    # Returns the entries that retention policies select for removal, oldest
+    # first
+    def select_entries(self, entries):
+        version_mtimes = {}
+        for group, version, path, mtime in entries:
+            if group is None:
+                continue
+            key = (group, version)
+            version_mtimes[key] = max(version_mtimes.get(key, 0), mtime)
+
+        group_versions = {}
+        for (group, version), mtime in version_mtimes.items():
+            group_versions.setdefault(group, []).append((mtime, version))
+
+        # Index of each version within its group, newest first
+        version_ranks = {}
+        for group, versions in group_versions.items():
+            versions.sort(reverse=True)
+            for rank, (_, version) in enumerate(versions):
+                version_ranks[(group, version)] = rank
+
+        now = time.time()
+        selected = []
+        kept = []
+        for entry in sorted(entries, key=lambda e: e[3]):
+            group, version, path, mtime = entry
+            rank = version_ranks.get((group, version), None)
+            if rank == 0:
+                continue
+            if rank is not None and self.keep_versions is not None and \
+                    rank >= self.keep_versions:
+                selected.append(entry)
+            elif self.max_age_days is not None and \
+                    now - mtime > self.max_age_days * 24 * 3600:
+                selected.append(entry)
+            else:
+                kept.append(entry)
+
+        if self.max_size is not None:
+            seen_inodes = set()
+            total_size = sum(get_tree_size(e[2], seen_inodes) for e in entries)
+            links = TreeLinks()
+            for entry in selected:
+                links.add(TreeLinks.scan(entry[2]))
+            for entry in kept:
+                if total_size - links.reclaimable_size <= self.max_size:
+                    break
+                links.add(TreeLinks.scan(entry[2]))
+                selected.append(entry)
+
+        return selected
+
+    def remove_path(self, path):
+        with self.lock:
+            if os.path.abspath(path) in self.protected_paths:
+                return False
+            # Move the tree out of the way before removing it so that a build
+            # starting in the meantime does not see a partially removed tree
+            removed_path = '{0}.gc-{1}'.format(path, os.getpid())
+            try:
+                os.rename(path, removed_path)
+            except OSError:
+                return False
+
+        shutil.rmtree(removed_path, ignore_errors=True)
+        return True
+
+    def run(self):
+        links = TreeLinks()
+        for _, _, path, _ in self.select_entries(self.collect_entries()):
+            inodes = TreeLinks.scan(path)
+            if self.remove_path(path):
+                self.removed_count += 1
+                links.add(inodes)
+        self.reclaimed_size = links.reclaimable_size
+
+    def start(self):
+        # Not a daemon thread so that trees are never left half-removed on exit
+        self.thread = threading.Thread(target=self.run, name='gc')
+        self.thread.start()
+
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.report()
+
+    def report(self):
+        out('GC: removed {0} directories, reclaimed {1}'.format(
+            self.removed_count, format_size(self.reclaimed_size)))
+
+
+# Returns the list of paragraphs in a deb822 file (e.g. debian/control), each
+# represented as a dict from field name to value
+def parse_deb822(path):
+    paragraphs = []
+    fields = {}
+    name = None
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.startswith('#'):
+                continue
+            if not line.strip():
+                if fields:
+                    paragraphs.append(fields)
+                fields = {}
+                name = None
+                continue
+            if line[0] in ' \t':
+                if name is not None:
+                    fields[name] += '\n' + line.strip()
+                continue
+            name, _, value = line.partition(':')
+            name = name.strip()
+            fields[name] = value.strip()
+    if fields:
+        paragraphs.append(fields)
+    return paragraphs
+
+
+Relation = collections.namedtuple('Relation', ['name', 'version', 'arches', 'profiles'])
+
+
+# Parses a relationship field such as Build-Depends. Returns a list of
+# dependencies, each of which is a list of alternative Relation tuples.
+def parse_relations(text):
+    dependencies = []
+    for dependency in text.split(','):
+        alternatives = []
+        for alternative in dependency.split('|'):
+            m = re.match(r'^\s*([^\s(\[<:]+)(?::\S+)?\s*(?:\(([^)]*)\))?\s*' +
+                         r'(?:\[([^\]]*)\])?\s*((?:<[^>]*>\s*)*)$', alternative)
+            if not m:
+                continue
+            alternatives.append(Relation(m.group(1),
+                                         m.group(2).strip() if m.group(2) else None,
+                                         m.group(3).split() if m.group(3) else [],
+                                         re.findall(r'<([^>]*)>', m.group(4))))
+        if alternatives:
+            dependencies.append(alternatives)
+    return dependencies
+
+
+def get_build_depends(fields):
+    build_depends = []
+    for field in ['Build-Depends', 'Build-Depends-Arch', 'Build-Depends-Indep']:
+        build_depends += parse_relations(fields.get(field, ''))
+    return build_depends
+
+
+# Returns whether a Relation applies when building for the given architecture
+# with the given set of build profiles. Architecture wildcards are assumed to
+# match.
+def is_relation_active(relation, arch, profiles):
+    if relation.arches:
+        negated = [a[1:] for a in relation.arches if a.startswith('!')]
+        if negated:
+            if arch in negated:
+                return False
+        elif arch not in relation.arches and \
+                not any('any' in a for a in relation.arches):
+            return False
+
+    if relation.profiles:
+        def is_term_satisfied(term):
+            if term.startswith('!'):
+                return term[1:] not in profiles
+            return term in profiles
+
+        return any(all(is_term_satisfied(term) for term in restriction.split())
+                   for restriction in relation.profiles)
+    return True
+
+
+# Packaging metadata parsed from a debian directory: the head of the
+# changelog, the package names and build dependencies from the control file
+# and the source format.
+class DebianMetadata:
+
+    def __init__(self, debian_path):
+        self.debian_path = debian_path
+        self.changelog_path = os.path.join(debian_path, 'changelog')
+        self.control_path = os.path.join(debian_path, 'control')
+        self.format_path = os.path.join(debian_path, 'source', 'format')
+        self.mtimes = self.get_mtimes(debian_path)
+
+        self.name, self.version, self.deb_version = self.parse_changelog_head()
+
+        paragraphs = []
+        if os.path.isfile(self.control_path):
+            paragraphs = parse_deb822(self.control_path)
+
+        source = paragraphs[0] if paragraphs else {}
+        self.source_name = source.get('Source', self.name)
+        self.binary_packages = [p['Package'] for p in paragraphs[1:] if 'Package' in p]
+        self.build_depends = get_build_depends(source)
+
+        self.source_format = '1.0'
+        if os.path.isfile(self.format_path):
+            with open(self.format_path) as f:
+                self.source_format = f.read().strip()
+
+    @staticmethod
+    def get_mtimes(debian_path):
+        mtimes = []
+        for fn in ['changelog', 'control', 'source/format']:
+            try:
+                mtimes.append(os.stat(os.path.join(debian_path, fn)).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def is_up_to_date(self):
+        return self.get_mtimes(self.debian_path) == self.mtimes
+
+    def parse_changelog_head(self):
+        if not os.path.exists(self.changelog_path):
+            raise BuildError('could not extract debian changelog')
+
+        with open(self.changelog_path) as f:
+            line = f.readline()
+        if not line:
+            raise BuildError('could not match any changelog line')
+
+        m = re.match(r'^\s*([\w_+-.]+)\s*\(([\w_.:+~]+)(?:-([\w_.~+:]+))?\)', line)
+        if not m:
+            raise BuildError('could not match changelog line: \'{0}\''.format(line))
+        name = m.group(1)
+        ver = m.group(2)
+        deb_ver = m.group(3)
+
+        # strip epoch
+        if ':' in ver:
+            epoch, sep, ver = ver.rpartition(':')
+
+        return (name, ver, deb_ver)
+
+    def get_build_depends_names(self, arch=None, profiles=()):
+        names = []
+        for alternatives in self.build_depends:
+            relation = alternatives[0]
+            if arch is None or is_relation_active(relation, arch, profiles):
+                names.append(relation.name)
+        return names
+
+
 class BuildType(enum.Enum):
     NONE = 0
     AUTOTOOLS = 1
     CMAKE = 2
     QMAKE = 3
     MAKEFILE = 4
+    MESON = 5
 
 
 class VcsType(enum.Enum):
@@ -261,6 +1926,159 @@ class VcsType(enum.Enum):
     GIT = 1
 
 
+class PackageStage(enum.Enum):
+    DISTRIBUTABLE = 1
+    SOURCE = 2
+    BINARY = 3
+    PUBLISH = 4
+
+
+# Checkpointed phases of a package build. The DISTRIBUTABLE stage consists of
+# the DISTRIBUTABLE and STAGING phases, the other stages have a phase of their
+# own. Pristine builds have no DISTRIBUTABLE and STAGING phases.
+class PackagePhase(enum.Enum):
+    DISTRIBUTABLE = 1
+    STAGING = 2
+    SOURCE = 3
+    BINARY = 4
+    PUBLISH = 5
+
+
+# Options and intermediate state of a single package build of a project. The
+# build is split into stages (see PackageStage) that are run by
+# Project.run_package_stage().
+class PackageJob:
+
+    def __init__(self, pristine=False, bare=False, do_source=False, do_check=True,
+                 use_dist=False, use_pbuilder=False, arch=None, pbuilder_profiles=None,
+                 use_cache=True, do_build=False, do_check_build=False, fast_compression=False,
+                 resume=False, action=None, arches=None):
+        self.pristine = pristine
+        self.bare = bare
+        self.do_source = do_source
+        self.do_check = do_check
+        self.use_dist = use_dist
+        self.use_pbuilder = use_pbuilder
+        self.arch = arch
+        # If set, a single source package is built and the binary packages
+        # are built for each of these architectures concurrently
+        self.arches = arches
+        self.pbuilder_profiles = pbuilder_profiles
+        self.use_cache = use_cache
+        self.fast_compression = fast_compression
+        # Whether to build and check the source tree before packaging
+        self.do_build = do_build
+        self.do_check_build = do_check_build
+        # Whether to skip the phases that have completed in an earlier run
+        self.resume = resume
+        # The Action that publishes the packages
+        self.action = action
+
+        # Maps the names of the local projects that the project build-depends
+        # on, directly or indirectly, to their build record fingerprints. Part
+        # of the artifact cache key, see get_dependency_fingerprints()
+        self.dependency_fingerprints = None
+
+        # Set when the results have been restored from the artifact cache
+        self.restored = False
+        self.cache_key = None
+        self.result_path = None
+        self.tar_file = None
+        self.tar_path = None
+        self.dsc_path = None
+        # Maps each of arches to the packaging build directory of its results
+        self.arch_result_paths = {}
+        self.checkpoints = None
+        self.fingerprints = {}
+        # The last phase that has completed in an earlier run and the state
+        # of the job after it
+        self.resume_phase = None
+        self.resume_state = None
+        # List of (staging_path, persistent_path, size) for build directories
+        # placed on the tmpfs
+        self.staging = []
+
+
+# Runs items through a sequence of stages connected by queues. Each stage has
+# a thread of its own, so consecutive items can be in different stages at the
+# same time while each stage processes items in order.
+#
+# If a stage fails for an item and on_error is given, on_error(item, e) is
+# called and the item is dropped from the remaining stages. Otherwise, or if
+# on_error raises, the items that have not completed their stages yet are
+# dropped and the failure is re-raised by run(). If run() is interrupted,
+# e.g. by KeyboardInterrupt, the running commands are killed and the stages
+# stop before it re-raises.
+class Pipeline:
+
+    def __init__(self, stages, on_error=None):
+        self.stages = stages
+        self.on_error = on_error
+        self.failure = None
+        self.stopped = False
+        self.lock = threading.Lock()
+
+    def run_stage(self, index, in_queue, out_queue):
+        name, func = self.stages[index]
+        try:
+            while True:
+                item = in_queue.get()
+                if item is None:
+                    return
+
+                with self.lock:
+                    if self.failure is not None or self.stopped:
+                        continue
+                try:
+                    try:
+                        func(item)
+                    except Exception as e:
+                        if self.on_error is None:
+                            raise
+                        self.on_error(item, e)
+                        continue
+                except Exception as e:
+                    with self.lock:
+                        if self.failure is None:
+                            self.failure = e
+                    continue
+
+                if out_queue is not None:
+                    out_queue.put(item)
+        finally:
+            # Lets the next stage finish even if this one exits abnormally
+            if out_queue is not None:
+                out_queue.put(None)
+
+    def run(self, items):
+        queues = [queue.Queue() for _ in self.stages] + [None]
+        threads = []
+        for i, (name, _) in enumerate(self.stages):
+            thread = threading.Thread(target=self.run_stage, name=name,
+                                      args=(i, queues[i], queues[i + 1]))
+            thread.start()
+            threads.append(thread)
+
+        try:
+            for item in items:
+                queues[0].put(item)
+            queues[0].put(None)
+
+            for thread in threads:
+                thread.join()
+        except BaseException:
+            with self.lock:
+                self.stopped = True
+            queues[0].put(None)
+            get_command_engine().cancel_all()
+            for thread in threads:
+                thread.join()
+            raise
+
+        if self.failure is not None:
+            raise self.failure
+
+
 def get_configure_args(proj_name):
     config_path = os.path.join(os.environ['HOME'], '.config', 'p12build', 'configure-' + proj_name)
     if not os.path.exists(config_path):
@@ -270,30 +2088,420 @@ def get_configure_args(proj_name):
         return f.readlines()
 
 
+# Returns the path of a pbuilder configuration file containing the given
+# lines. pbuilder reads it after the system and user configuration when
+# passed via --configfile.
+def get_pbuilderrc(paths, lines):
+    text = '\n'.join(lines) + '\n'
+    path = os.path.join(paths.build_pbuilder_path,
+                        'pbuilderrc-' + hashlib.sha256(text.encode()).hexdigest()[:16])
+    if not os.path.isfile(path):
+        with open(path + '.new', 'w') as f:
+            f.write(text)
+        os.rename(path + '.new', path)
+    return path
+
+
+# Collects the .changes files of the packages built during a run so that they
+# are signed together with debsign at the end of the run instead of within
+# each build. The builds don't wait for the key agent and the passphrase is
+# asked for at most once per key.
+class SigningQueue:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Maps each key to a list of (project, changes path) tuples
+        self.entries = collections.OrderedDict()
+
+    def add(self, pr, key, changes_path):
+        with self.lock:
+            self.entries.setdefault(key, []).append((pr, changes_path))
+
+    # Signs the queued packages. The .dsc and .buildinfo files referenced by
+    # the .changes files are signed too, so the manifests of the packaging
+    # build directories are rewritten afterwards.
+    def sign_all(self):
+        with self.lock:
+            entries = list(self.entries.items())
+            self.entries = collections.OrderedDict()
+
+        for key, items in entries:
+            changes_paths = [changes_path for _, changes_path in items]
+            out('Signing {0} packages with key {1}'.format(len(changes_paths), key))
+            sh(['debsign', '-k' + key, '--re-sign'] + changes_paths,
+               cwd=os.path.dirname(changes_paths[0]))
+
+            pkgver_paths = collections.OrderedDict()
+            for pr, changes_path in items:
+                pkgver_paths[os.path.dirname(changes_path)] = pr
+            for pkgver_path, pr in pkgver_paths.items():
+                pr.write_manifest(pkgver_path)
+
+
+# A flat apt repository that is bind-mounted into pbuilder chroots, so that
+# builds can use packages that are not in the base tarball yet. In 'archive'
+# mode the repository mirrors the packages of the local archive, in 'run' mode
+# it holds the packages built by the current run.
+class LocalRepository:
+
+    def __init__(self, paths, mode):
+        self.paths = paths
+        self.mode = mode
+        if mode == 'archive':
+            self.path = os.path.join(paths.build_pbuilder_path, 'localrepo', 'archive')
+        else:
+            self.path = os.path.join(paths.build_pbuilder_path, 'localrepo',
+                                     'run-{0}'.format(os.getpid()))
+        self.lock = threading.Lock()
+        self.changed = True
+        self.hook_path = None
+
+    # Adds the .deb packages in the given directories to the repository
+    def add(self, dirs):
+        with self.lock:
+            os.makedirs(self.path, exist_ok=True)
+            for d in dirs:
+                for fn in os.listdir(d):
+                    if fn.endswith('.deb'):
+                        dst = os.path.join(self.path, fn)
+                        if os.path.exists(dst):
+                            os.remove(dst)
+                        ArtifactCache.link_or_copy(os.path.join(d, fn), dst)
+                        self.changed = True
+
+    # Makes the repository contain exactly the packages of the local archive
+    def sync_archive(self):
+        with self.lock:
+            os.makedirs(self.path, exist_ok=True)
+            archive_path = self.paths.archive_path
+            wanted = set()
+            if os.path.isdir(archive_path):
+                wanted = {fn for fn in os.listdir(archive_path) if fn.endswith('.deb')}
+            for fn in os.listdir(self.path):
+                if fn.endswith('.deb') and fn not in wanted:
+                    os.remove(os.path.join(self.path, fn))
+                    self.changed = True
+            for fn in wanted:
+                src = os.path.join(archive_path, fn)
+                dst = os.path.join(self.path, fn)
+                if not os.path.exists(dst) or \
+                        os.path.getmtime(dst) != os.path.getmtime(src):
+                    if os.path.exists(dst):
+                        os.remove(dst)
+                    ArtifactCache.link_or_copy(src, dst)
+                    self.changed = True
+
+    # Returns a fingerprint of the mode and of the packages that the
+    # repository holds, or will hold in 'archive' mode once synced
+    def get_fingerprint(self):
+        path = self.paths.archive_path if self.mode == 'archive' else self.path
+        packages = []
+        with self.lock:
+            if os.path.isdir(path):
+                for fn in sorted(os.listdir(path)):
+                    if fn.endswith('.deb'):
+                        st = os.stat(os.path.join(path, fn))
+                        packages.append([fn, st.st_size, st.st_mtime])
+        return ArtifactCache.compute_key({'mode': self.mode, 'packages': packages})
+
+    # Regenerates the package index if the contents have changed
+    def update_index(self):
+        with self.lock:
+            os.makedirs(self.path, exist_ok=True)
+            if not self.changed:
+                return
+            if shutil.which('apt-ftparchive') is not None:
+                sh('apt-ftparchive packages . > Packages.new', cwd=self.path)
+            else:
+                sh('dpkg-scanpackages --multiversion . /dev/null > Packages.new', cwd=self.path)
+            os.replace(os.path.join(self.path, 'Packages.new'),
+                       os.path.join(self.path, 'Packages'))
+            self.changed = False
+
+    # Prepares the repository for a build and returns the pbuilder
+    # configuration lines that make it available in the chroot. A hook adds
+    # the repository to the apt sources before the build dependencies are
+    # installed and pins it above all other repositories. As the hook
+    # directory replaces the HOOKDIR of the pbuilder configuration, the hooks
+    # from there are copied into it.
+    def get_pbuilder_config_lines(self):
+        if self.mode == 'archive':
+            self.sync_archive()
+        self.update_index()
+
+        hook_lines = [
+            '#!/bin/sh',
+            'set -e',
+            'echo "deb [trusted=yes] file://{0} ./" '
+            '> /etc/apt/sources.list.d/make_all-local.list'.format(self.path),
+            'printf "Package: *\\nPin: origin \\"\\"\\nPin-Priority: 990\\n" '
+            '> /etc/apt/preferences.d/make_all-local',
+            'apt-get update -o Dir::Etc::sourcelist=sources.list.d/make_all-local.list '
+            '-o Dir::Etc::sourceparts=- -o APT::Get::List-Cleanup=0',
+        ]
+        text = '\n'.join(hook_lines) + '\n'
+        hook_path = os.path.join(self.paths.build_pbuilder_path,
+                                 'hooks-' + hashlib.sha256(text.encode()).hexdigest()[:16])
+        self.hook_path = hook_path
+        hook_file = os.path.join(hook_path, 'D05make-all-local-repo')
+        if not os.path.isfile(hook_file):
+            os.makedirs(hook_path, exist_ok=True)
+            with open(hook_file + '.new', 'w') as f:
+                f.write(text)
+            os.chmod(hook_file + '.new', 0o755)
+            os.rename(hook_file + '.new', hook_file)
+        self.sync_user_hooks(hook_path, os.path.basename(hook_file))
+
+        return [
+            'BINDMOUNTS="$BINDMOUNTS {0}"'.format(self.path),
+            'HOOKDIR={0}'.format(hook_path),
+        ]
+
+    # Makes hook_path contain the hooks of the HOOKDIR of the pbuilder
+    # configuration besides own_hook
+    def sync_user_hooks(self, hook_path, own_hook):
+        user_hook_path = get_pbuilder_hookdir()
+        wanted = set()
+        if user_hook_path is not None and os.path.isdir(user_hook_path):
+            wanted = {fn for fn in os.listdir(user_hook_path)
+                      if fn != own_hook and os.path.isfile(os.path.join(user_hook_path, fn))}
+        with self.lock:
+            for fn in os.listdir(hook_path):
+                if fn != own_hook and fn not in wanted:
+                    os.remove(os.path.join(hook_path, fn))
+            for fn in wanted:
+                tmp_path = os.path.join(hook_path, '.{0}.new'.format(fn))
+                shutil.copy2(os.path.join(user_hook_path, fn), tmp_path)
+                os.rename(tmp_path, os.path.join(hook_path, fn))
+
+    # Removes the repository of a run
+    def remove(self):
+        if self.mode == 'run':
+            shutil.rmtree(self.path, ignore_errors=True)
+            if self.hook_path is not None:
+                shutil.rmtree(self.hook_path, ignore_errors=True)
+
+
+# Returns the HOOKDIR set by the pbuilder configuration files of the user, if
+# any
+@functools.lru_cache(maxsize=None)
+def get_pbuilder_hookdir():
+    script = ('for f in /usr/share/pbuilder/pbuilderrc /etc/pbuilderrc "$HOME/.pbuilderrc"; do '
+              '[ ! -f "$f" ] || . "$f"; done; printf %s "$HOOKDIR"')
+    try:
+        r = subprocess.run(['sh', '-c', script], stdin=subprocess.DEVNULL,
+                           stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError:
+        return None
+    return r.stdout.decode('utf-8').strip() or None
+
+
 def get_pbuilder_othermirror_opt(othermirror):
     if othermirror is None:
         return []
     return ['--othermirror', othermirror]
 
 
+# Downloads build dependencies into the pbuilder apt cache so that the
+# dependency installation within the chroot does not need to hit the network.
+#
+# Dependencies are resolved by the host apt-get against a private apt state
+# that points to the mirror of the target distribution. The dpkg status of the
+# base tgz is used so that packages that are already installed in the chroot
+# are not downloaded.
+class BuildDependsPrefetcher:
+
+    def __init__(self, paths, jobs=8):
+        self.paths = paths
+        self.jobs = jobs
+        self.state_path = paths.pbuilder_aptstate_path
+        self.cache_path = paths.pbuilder_cache_path
+        self.thread = None
+        self.lock = threading.Lock()
+        self.downloaded_count = 0
+        self.downloaded_size = 0
+
+    def get_apt_options(self):
+        options = {
+            'Dir::State': os.path.join(self.state_path, 'state'),
+            'Dir::State::status': os.path.join(self.state_path, 'status'),
+            'Dir::Etc::SourceList': os.path.join(self.state_path, 'sources.list'),
+            'Dir::Etc::SourceParts': os.path.join(self.state_path, 'sources.list.d'),
+            'Dir::Cache': os.path.join(self.state_path, 'cache'),
+            'Dir::Cache::archives': self.cache_path,
+            'APT::Architecture': self.paths.arch,
+            'APT::Architectures': self.paths.arch,
+            'APT::Install-Recommends': 'false',
+            'Debug::NoLocking': 'true',
+        }
+        args = []
+        for key, value in options.items():
+            args += ['-o', '{0}={1}'.format(key, value)]
+        return args
+
+    def write_sources_list(self):
+        options = 'arch={0}'.format(self.paths.arch)
+        if os.path.isfile(self.paths.pbuilder_keyring):
+            options += ' signed-by={0}'.format(self.paths.pbuilder_keyring)
+
+        components_str = ' '.join(self.paths.pbuilder_components)
+        lines = ['deb [{0}] {1} {2} {3}'.format(options, self.paths.pbuilder_mirror,
+                                                self.paths.dist_distribution, components_str)]
+        if self.paths.pbuilder_othermirror is not None:
+            lines.append(self.paths.pbuilder_othermirror)
+
+        with open(os.path.join(self.state_path, 'sources.list'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    # Extracts the dpkg status of the base tgz unless it is already up to date
+    def extract_base_status(self):
+        status_path = os.path.join(self.state_path, 'status')
+        if os.path.isfile(status_path) and \
+                os.path.getmtime(status_path) >= os.path.getmtime(self.paths.pbuilder_tgz):
+            return
+
+        with open(status_path + '.new', 'wb') as f:
+            subprocess.run(['tar', '-xzOf', self.paths.pbuilder_tgz, './var/lib/dpkg/status'],
+                           stdout=f, check=True)
+        os.rename(status_path + '.new', status_path)
+
+    def prepare(self):
+        for path in ['state/lists/partial', 'cache/archives/partial', 'sources.list.d']:
+            os.makedirs(os.path.join(self.state_path, path), exist_ok=True)
+        os.makedirs(os.path.join(self.cache_path, 'partial'), exist_ok=True)
+
+        self.write_sources_list()
+        self.extract_base_status()
+        subprocess.run(['apt-get', '-qq', 'update'] + self.get_apt_options(),
+                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True)
+
+    # Returns a list of (uri, filename, size, hash) tuples for the packages
+    # that need to be downloaded to install the given packages. Returns None
+    # if the packages could not be resolved.
+    def resolve_uris(self, names):
+        r = subprocess.run(['apt-get', '-qq', '-y', '--print-uris', 'install'] +
+                           self.get_apt_options() + names,
+                           stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if r.returncode != 0:
+            return None
+
+        uris = []
+        for line in r.stdout.decode('utf-8').splitlines():
+            m = re.match(r"^'([^']+)'\s+(\S+)\s+(\d+)\s*(\S*)", line)
+            if m:
+                uris.append((m.group(1), m.group(2), int(m.group(3)), m.group(4)))
+        return uris
+
+    def download(self, uri, filename, size, checksum):
+        dest_path = os.path.join(self.cache_path, filename)
+        if os.path.isfile(dest_path) and os.path.getsize(dest_path) == size:
+            return
+
+        # pbuilder picks up only *.deb files from the cache
+        partial_path = os.path.join(self.cache_path, 'partial', filename)
+        h = hashlib.sha256()
+        with urllib.request.urlopen(uri) as response, open(partial_path, 'wb') as f:
+            for chunk in iter(lambda: response.read(1 << 20), b''):
+                h.update(chunk)
+                f.write(chunk)
+
+        if checksum.startswith('SHA256:') and checksum[len('SHA256:'):] != h.hexdigest():
+            os.remove(partial_path)
+            raise Exception('checksum mismatch for ' + uri)
+        os.rename(partial_path, dest_path)
+        with self.lock:
+            self.downloaded_count += 1
+            self.downloaded_size += size
+
+    def run(self, names):
+        names = sorted(set(names))
+        if not names:
+            return
+        try:
+            self.prepare()
+        except (OSError, subprocess.CalledProcessError) as e:
+            out('WARN: Could not prepare build dependency prefetch: {0}'.format(e))
+            return
+
+        uris = self.resolve_uris(names)
+        if uris is None:
+            # Some dependency can't be resolved on its own (e.g. a virtual
+            # package). Prefetch whatever can be resolved.
+            uris = []
+            for name in names:
+                uris += self.resolve_uris([name]) or []
+            uris = list({uri[1]: uri for uri in uris}.values())
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = [executor.submit(self.download, *uri) for uri in uris]
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    out('WARN: Could not prefetch build dependency: {0}'.format(e))
+
+        out('Prefetched {0} build dependencies ({1})'.format(
+            self.downloaded_count, format_size(self.downloaded_size)))
+
+    def start(self, names):
+        self.thread = threading.Thread(target=self.run, args=(names,), name='prefetch',
+                                       daemon=True)
+        self.thread.start()
+
+
 class Project:
 
     def __init__(self, paths, proj_name, proj_dir):
         self.paths = paths
         self.proj_name = proj_name
         self.proj_dir = proj_dir
+        self.config = paths.config
 
         self.log_file = os.path.join(self.paths.log_path, self.proj_name)
         self.code_path = self.proj_dir
         self.build_path = os.path.join(self.paths.build_path, self.proj_name)
+        self.tmpfs_build_path = None
+        # The space on the tmpfs taken by the build directory created by this
+        # process
+        self.tmpfs_build_size = 0
+        if self.paths.tmpfs_staging is not None:
+            self.tmpfs_build_path = self.paths.tmpfs_staging.get_path('build', self.proj_name)
+            if os.path.isdir(self.tmpfs_build_path):
+                self.build_path = self.tmpfs_build_path
         self.pkg_path = os.path.join(self.paths.pkg_path, self.proj_name)
         self.build_pkg_path = os.path.join(self.paths.build_pkg_path,
                                            self.proj_name)
         self.build_pkgver_path = None
+        self.artifact_cache = ArtifactCache(self.paths.artifact_cache_path)
+        self.debian_path = None
+        self.debian_path_found = False
+        self.debian_metadata = {}
 
         self.build_type = self.get_build_type()
         self.vcs_type = self.get_vcs_type()
 
+    # Keeps the concurrently running GarbageCollector, if any, from removing
+    # the path
+    def protect_path(self, path):
+        if self.paths.gc is not None:
+            self.paths.gc.protect_path(path)
+
+    # Attributes the commands run within the block to the given phase of the
+    # project and applies the watchdog and resource limits configured for it.
+    # Unexpected errors, e.g. from file operations, are raised as BuildError of
+    # the phase, so that --keep-going continues with the other projects.
+    @contextlib.contextmanager
+    def phase_context(self, phase):
+        with command_context(self.proj_name, phase, self.log_file,
+                             get_config_watchdog_limits(self.config, self.proj_name, phase),
+                             get_config_resources(self.config, self.proj_name)):
+            try:
+                yield
+            except (BuildError, ProjectSkipped):
+                raise
+            except Exception as e:
+                raise BuildError('{0}: {1}'.format(type(e).__name__, e)) from e
+
     def get_build_type(self):
 
         if (os.path.exists(self.code_path + '/configure') or
@@ -303,6 +2511,8 @@ class Project:
             return BuildType.QMAKE
         if os.path.exists(self.code_path + '/CMakeLists.txt'):
             return BuildType.CMAKE
+        if os.path.exists(self.code_path + '/meson.build'):
+            return BuildType.MESON
         if os.path.exists(self.code_path + "/Makefile"):
             return BuildType.MAKEFILE
         return BuildType.NONE
@@ -313,12 +2523,32 @@ class Project:
             return VcsType.GIT
         return VcsType.NONE
 
+    @project_phase('build')
     def build(self, do_build=True):
         if not do_build:
             return
 
         out('Configuring project \'{0}\''.format(self.proj_name))
 
+        # Fresh builds go to the tmpfs if they fit. Existing build
+        # directories stay where they are to keep incremental builds working.
+        reserved_size = None
+        if self.tmpfs_build_path is not None and not os.path.isdir(self.build_path):
+            size = self.estimate_build_size()
+            if self.paths.tmpfs_staging.reserve(size):
+                self.build_path = self.tmpfs_build_path
+                reserved_size = size
+
+        try:
+            self.build_impl()
+        finally:
+            # Whether or not the build succeeded, the build directory only
+            # keeps the space that it actually takes until it is cleaned
+            if reserved_size is not None:
+                self.tmpfs_build_size += self.paths.tmpfs_staging.settle(
+                    reserved_size, self.tmpfs_build_path)
+
+    def build_impl(self):
         out("Code path: \'{0}\'".format(self.code_path))
         out("Build path: \'{0}\'".format(self.build_path))
         out("Pkg build path: \'{0}\'".format(self.build_pkg_path))
@@ -352,14 +2582,14 @@ class Project:
             # reconfigure if needed
 
             if build_mtime < c_mtime:
-                shutil.rmtree(self.build_path)
+                self.paths.trash.remove(self.build_path)
                 os.makedirs(self.build_path)
                 sh([configure_path] + get_configure_args(self.proj_name),
                    cwd=self.build_path)
 
             # build
             out('Building project \'{0}\''.format(self.proj_name))
-            sh(['make', 'all', '-j{0}'.format(get_config_cpu_cores(self.proj_name))],
+            sh(['make', 'all', '-j{0}'.format(get_config_cpu_cores(self.config, self.proj_name))],
                cwd=self.build_path)
 
         elif self.build_type == BuildType.CMAKE:
@@ -372,9 +2602,22 @@ class Project:
             sh(cmd, cwd=self.build_path)
 
             out('Building project \'{0}\''.format(self.proj_name))
-            sh(['make', 'all', '-j{0}'.format(get_config_cpu_cores(self.proj_name))],
+            sh(['make', 'all', '-j{0}'.format(get_config_cpu_cores(self.config, self.proj_name))],
                cwd=self.build_path)
 
+        elif self.build_type == BuildType.MESON:
+            # meson project. Once the build directory is set up, ninja reruns
+            # meson by itself whenever the build definitions change
+            if not self.is_meson_build_dir_valid():
+                self.paths.trash.remove(self.build_path)
+                os.makedirs(self.build_path)
+                sh(['meson', 'setup'] + get_configure_args(self.proj_name) +
+                   [self.build_path, self.code_path], cwd=self.build_path)
+
+            out('Building project \'{0}\''.format(self.proj_name))
+            num_cores = get_config_cpu_cores(self.config, self.proj_name)
+            sh(['ninja', '-j{0}'.format(num_cores)], cwd=self.build_path)
+
         elif self.build_type == BuildType.QMAKE:
             # qmake project
             os.makedirs(self.paths.build_path, exist_ok=True)
@@ -391,7 +2634,7 @@ class Project:
             sh(['qmake', '../{0}'.format(code_dir)], cwd=self.paths.build_path)
 
             out('Building project \'{0}\''.format(self.proj_name))
-            sh(['make', 'all', '-j{0}'.format(get_config_cpu_cores(self.proj_name))],
+            sh(['make', 'all', '-j{0}'.format(get_config_cpu_cores(self.config, self.proj_name))],
                cwd=self.paths.build_path)
 
         elif self.build_type == BuildType.MAKEFILE:
@@ -411,21 +2654,26 @@ class Project:
             if (build_mtime < c_mtime):
                 out('Building project \'{0}\''.format(self.proj_name))
 
-                shutil.rmtree(self.build_path)
+                self.paths.trash.remove(self.build_path)
                 shutil.copytree(self.code_path, self.build_path)
 
-                sh(['make', 'all', '-j{0}'.format(get_config_cpu_cores(self.proj_name))],
-                   cwd=self.build_path)
+                num_cores = get_config_cpu_cores(self.config, self.proj_name)
+                sh(['make', 'all', '-j{0}'.format(num_cores)], cwd=self.build_path)
         else:
             # No makefile -- nothing to build, only package. We expect that
             # debian/rules will have enough information
             out('... (no Makefile)')
 
+    @project_phase('clean')
     def clean(self):
         out('Cleaning project \'{0}\''.format(self.proj_name))
 
-        if os.path.isdir(self.build_path):
-            shutil.rmtree(self.build_path)
+        for path in [os.path.join(self.paths.build_path, self.proj_name), self.tmpfs_build_path]:
+            if path is not None and os.path.isdir(path):
+                self.paths.trash.remove(path)
+        if self.tmpfs_build_size:
+            self.paths.tmpfs_staging.release(self.tmpfs_build_size)
+            self.tmpfs_build_size = 0
 
         if os.path.isdir(self.build_pkg_path):
             files = os.listdir(self.build_pkg_path)
@@ -436,6 +2684,78 @@ class Project:
                         re.search(r'\.dsc$', f)):
                     os.remove(os.path.join(self.build_pkg_path, f))
 
+    def estimate_build_size(self):
+        size = 0
+        for dirname, subdirs, files in os.walk(self.code_path):
+            if '.git' in subdirs:
+                subdirs.remove('.git')
+            for fname in files:
+                try:
+                    size += os.lstat(os.path.join(dirname, fname)).st_size
+                except OSError:
+                    pass
+        return int(size * self.config.get('tmpfs_size_factor', 4))
+
+    # Returns the directory to use instead of persistent_path during the
+    # build. The directory is on the tmpfs if it fits into the budget.
+    def allocate_staging(self, job, persistent_path):
+        staging = self.paths.tmpfs_staging
+        if staging is None:
+            return persistent_path
+
+        size = self.estimate_build_size()
+        if not staging.reserve(size):
+            out('Build does not fit into tmpfs budget, building on disk')
+            return persistent_path
+
+        staging_path = self.get_staging_path(persistent_path)
+        job.staging.append((staging_path, persistent_path, size))
+        return staging_path
+
+    # Returns the directory on the tmpfs that is used instead of
+    # persistent_path when the build fits into the budget
+    def get_staging_path(self, persistent_path):
+        staging = self.paths.tmpfs_staging
+        if staging is None:
+            return None
+        return staging.get_path('packaging', os.path.relpath(persistent_path,
+                                                             self.paths.root_path))
+
+    # Copies the packages from the tmpfs build directories to persistent
+    # storage and frees the tmpfs
+    def finish_staging(self, job):
+        for staging_path, persistent_path, size in job.staging:
+            self.clean_path(persistent_path)
+            if os.path.isdir(staging_path):
+                for fn in os.listdir(staging_path):
+                    path = os.path.join(staging_path, fn)
+                    if ArtifactCache.is_artifact(fn) and os.path.isfile(path):
+                        shutil.copy2(path, os.path.join(persistent_path, fn))
+                shutil.rmtree(staging_path, ignore_errors=True)
+            self.paths.tmpfs_staging.release(size)
+
+            if self.build_pkgver_path == staging_path:
+                self.build_pkgver_path = persistent_path
+            if job.result_path == staging_path:
+                job.result_path = persistent_path
+        job.staging = []
+
+    # Frees the tmpfs space reserved by a job that has failed. The staging
+    # directories of jobs run with --resume are kept so that the job can be
+    # resumed again, and the space that they actually take stays accounted
+    # for. Otherwise they are removed.
+    def abort_staging(self, job):
+        for staging_path, _, size in job.staging:
+            if not job.resume:
+                if os.path.isdir(staging_path):
+                    self.paths.trash.remove(staging_path)
+                self.paths.tmpfs_staging.release(size)
+            # Directories of resumed jobs have not been reserved by this process
+            elif size > 0:
+                self.paths.tmpfs_staging.settle(size, staging_path)
+        job.staging = []
+
+    @project_phase('reconf')
     def reconf(self):
         out('Reconfiguring project \'{0}\''.format(self.proj_name))
 
@@ -443,21 +2763,37 @@ class Project:
             sh(['autoreconf'], cwd=self.code_path)
         elif self.build_type == BuildType.CMAKE:
             sh(['cmake', '.'], cwd=self.code_path)
+        elif self.build_type == BuildType.MESON:
+            if self.is_meson_build_dir_valid():
+                sh(['meson', 'setup', '--reconfigure', self.build_path, self.code_path],
+                   cwd=self.build_path)
+
+    # Returns whether the build directory has been set up by meson
+    def is_meson_build_dir_valid(self):
+        return os.path.exists(os.path.join(self.build_path, 'build.ninja')) and \
+            os.path.exists(os.path.join(self.build_path, 'meson-private', 'coredata.dat'))
 
+    @project_phase('check')
     def check_build(self, do_check=True):
         if not do_check:
             return
 
         out('Checking project \'{0}\''.format(self.proj_name))
 
-        if self.build_type != BuildType.NONE:
+        if self.build_type == BuildType.MESON:
+            self.run_meson_test()
+        elif self.build_type != BuildType.NONE:
+            if os.path.exists(os.path.join(self.build_path, 'CTestTestfile.cmake')):
+                self.run_ctest()
+                return
+
             # launch make check
             mkpath = os.path.join(self.build_path, 'Makefile')
             if os.path.exists(mkpath):
                 mk = open(mkpath).read()
                 if re.search(r'\bcheck:', mk):
-                    sh(['make', 'check', '-j{0}'.format(get_config_cpu_cores(self.proj_name))],
-                       cwd=self.build_path)
+                    num_cores = get_config_cpu_cores(self.config, self.proj_name)
+                    sh(['make', 'check', '-j{0}'.format(num_cores)], cwd=self.build_path)
                 else:
                     out('... (no check rule)')
             else:
@@ -467,8 +2803,95 @@ class Project:
         else:
             out('... (no Makefile)')
 
+    # Runs the CTest suite of the project with as many tests in parallel as
+    # there are configured cores. ctest schedules the tests that were the
+    # slowest in the previous runs first.
+    def run_ctest(self):
+        num_cores = get_config_cpu_cores(self.config, self.proj_name)
+        cmd = ['ctest', '-j{0}'.format(num_cores), '--output-on-failure']
+
+        # JUnit output is supported since ctest 3.21. Older versions write the
+        # results to Testing/<tag>/Test.xml in dashboard mode.
+        junit_path = None
+        tag_path = os.path.join(self.build_path, 'Testing', 'TAG')
+        if get_ctest_version() >= (3, 21):
+            junit_path = os.path.join(self.build_path, 'Testing', 'make_all-junit.xml')
+            if os.path.exists(junit_path):
+                os.remove(junit_path)
+            cmd += ['--output-junit', junit_path]
+        else:
+            if os.path.exists(tag_path):
+                os.remove(tag_path)
+            cmd += ['-T', 'Test']
+
+        result = get_command_engine().run(cmd, cwd=self.build_path, check=False)
+
+        report_path = junit_path
+        if junit_path is None and os.path.exists(tag_path):
+            with open(tag_path) as f:
+                tag = f.readline().strip()
+            report_path = os.path.join(self.build_path, 'Testing', tag, 'Test.xml')
+
+        tests = []
+        if report_path is None or not os.path.exists(report_path):
+            out('WARN: ctest wrote no test results, per-test timings are not available')
+        elif junit_path is not None:
+            tests = parse_junit_report(junit_path)
+        else:
+            tests = parse_ctest_xml_report(report_path)
+        self.write_test_report('ctest', num_cores, result.duration, tests)
+
+        if not result.succeeded():
+            raise CommandError(result)
+
+    # Runs the meson test suite of the project with as many tests in parallel
+    # as there are configured cores
+    def run_meson_test(self):
+        num_cores = get_config_cpu_cores(self.config, self.proj_name)
+        testlog_path = os.path.join(self.build_path, 'meson-logs', 'testlog.json')
+        if os.path.exists(testlog_path):
+            os.remove(testlog_path)
+
+        result = get_command_engine().run(
+            ['meson', 'test', '--num-processes', str(num_cores), '--print-errorlogs'],
+            cwd=self.build_path, check=False)
+
+        tests = []
+        if os.path.exists(testlog_path):
+            tests = parse_meson_testlog(testlog_path)
+        self.write_test_report('meson', num_cores, result.duration, tests)
+
+        if not result.succeeded():
+            raise CommandError(result)
+
+    # Writes the results of the tests of the project to a JSON report in the
+    # log directory, slowest tests first
+    def write_test_report(self, runner, jobs, duration, tests):
+        tests = sorted(tests, key=lambda t: t['duration'], reverse=True)
+        report = {
+            'project': self.proj_name,
+            'runner': runner,
+            'jobs': jobs,
+            'duration': round(duration, 3),
+            'tests': tests,
+        }
+        os.makedirs(self.paths.log_path, exist_ok=True)
+        report_path = os.path.join(self.paths.log_path, self.proj_name + '.tests.json')
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+        failed = [t for t in tests if t['status'] == 'failed']
+        out('{0} tests, {1} failed, report written to {2}'.format(
+            len(tests), len(failed), report_path))
+        for test in tests[:5]:
+            out('  {0:8.2f}s  {1} ({2})'.format(
+                test['duration'], test['name'], test['status']))
+
     def find_debian_folder(self):
-        embedded_packaging_dir = get_config_embedded_packaging_dir(self.proj_name)
+        if self.debian_path_found:
+            return self.debian_path
+
+        embedded_packaging_dir = get_config_embedded_packaging_dir(self.config, self.proj_name)
         if embedded_packaging_dir is not None:
             embedded_packaging_dir = os.path.join(self.code_path, embedded_packaging_dir)
 
@@ -478,43 +2901,33 @@ class Project:
             ('code', os.path.join(self.code_path, 'debian')),
         ]
 
+        self.debian_path_found = True
+        self.debian_path = None
         for name, debian_path in candidate_paths:
             if debian_path is None or not os.path.isdir(debian_path):
                 continue
 
             out('Debian dir in {0} repo: {1}'.format(name, debian_path))
-            return debian_path
+            self.debian_path = debian_path
+            break
 
-        return None
+        return self.debian_path
 
-    def extract_changelog_version(self, deb_folder):
+    # Returns the DebianMetadata for the given debian folder. The metadata is
+    # parsed once and reused until any of the parsed files change.
+    def get_debian_metadata(self, deb_folder):
         if deb_folder is None:
-            out('ERROR: debian folder could not be found')
-            sys.exit(1)
+            raise BuildError('debian folder could not be found')
 
-        changelog_path = os.path.join(deb_folder, 'changelog')
-        if not os.path.exists(changelog_path):
-            out('ERROR: could not extract debian changelog')
-            sys.exit(1)
-        for line in open(changelog_path).readlines():
-            if line:
-                m = re.match(r'^\s*([\w_+-.]+)\s*\(([\w_.:+~]+)(?:-([\w_.~+:]+))?\)',
-                             line)
-                if not m:
-                    out('ERROR: could not match changelog line: \'{0}\''.format(
-                        line))
-                    sys.exit(1)
-                name = m.group(1)
-                ver = m.group(2)
-                deb_ver = m.group(3)
-
-                # strip epoch
-                if ':' in ver:
-                    epoch, sep, ver = ver.rpartition(':')
-
-                return (name, ver, deb_ver)
-        out('ERROR: could not match any changelog line')
-        sys.exit(1)
+        metadata = self.debian_metadata.get(deb_folder, None)
+        if metadata is None or not metadata.is_up_to_date():
+            metadata = DebianMetadata(deb_folder)
+            self.debian_metadata[deb_folder] = metadata
+        return metadata
+
+    def extract_changelog_version(self, deb_folder):
+        metadata = self.get_debian_metadata(deb_folder)
+        return (metadata.name, metadata.version, metadata.deb_version)
 
     # Imports debian directory for a project extracted to ext_tar_path. Exits
     # on failure
@@ -536,9 +2949,8 @@ class Project:
         build_pkg_debian_path = os.path.join(self.build_pkg_path, 'debian')
         shutil.copytree(ext_tar_debian_path, build_pkg_debian_path)
 
-        out("ERROR: Please update the debian configs at {0}".format(
-            build_pkg_debian_path))
-        sys.exit(1)
+        raise BuildError("Please update the debian configs at {0}".format(
+                         build_pkg_debian_path))
 
     # Finds the distributable tar.gz archive created by the make dist rule.
     # All tar.gz files within the build path are loosely matched with the
@@ -593,16 +3005,14 @@ class Project:
         dist_file = self.find_dist_tgz()
 
         if dist_file is None:
-            out("ERROR: Could not find distributable package (searched {})".format(self.proj_name))
-            out("ERROR: Candidate files in {}: {}".format(self.build_path,
-                                                          ' '.join(os.listdir(self.build_path))))
-            sys.exit(1)
+            raise BuildError(
+                "Could not find distributable package (searched {}). Candidate files in {}: {}"
+                .format(self.proj_name, self.build_path, ' '.join(os.listdir(self.build_path))))
 
         m = re.match(r'(^.*-[^-]*)\.(tar\.(?:gz|xz))$', dist_file, re.I)
         if not m:
-            out('ERROR: could not parse the filename of ' +
-                'an archive \'{0}\''.format(dist_file))
-            sys.exit(1)
+            raise BuildError('could not parse the filename of ' +
+                             'an archive \'{0}\''.format(dist_file))
 
         base, version, _ = \
             self.extract_changelog_version(self.find_debian_folder())
@@ -611,7 +3021,27 @@ class Project:
         dist_file = os.path.join(self.build_path, dist_file)
         return (base, version, tar_base, ext, dist_file)
 
-    def make_distributable_git_archive(self):
+    # Returns the gzip command to compress orig tarballs with
+    def get_gzip_cmd(self, fast_compression):
+        if not fast_compression:
+            return ['gzip']
+        level = '-{0}'.format(get_config_fast_compression_level(self.config, self.proj_name))
+        if shutil.which('pigz') is not None:
+            num_cores = get_config_cpu_cores(self.config, self.proj_name)
+            return ['pigz', level, '-p{0}'.format(num_cores)]
+        return ['gzip', level]
+
+    # Returns the timestamp of the files in the distributable archive: the
+    # SOURCE_DATE_EPOCH environment variable if set, otherwise the time of the
+    # last commit
+    def get_source_date_epoch(self):
+        if 'SOURCE_DATE_EPOCH' in os.environ:
+            return int(os.environ['SOURCE_DATE_EPOCH'])
+        r = get_command_engine().run(['git', 'log', '-1', '--format=%ct', 'HEAD'],
+                                     cwd=self.code_path, capture=True)
+        return int(r.output.strip())
+
+    def make_distributable_git_archive(self, fast_compression=False):
         out('Using git packager')
 
         base, version, _ = \
@@ -619,28 +3049,34 @@ class Project:
         tar_base = base + '-' + version
 
         dist_file = os.path.join(self.code_path, tar_base + '.tar.gz')
-
-        if os.path.isfile(os.path.join(self.code_path, '.gitmodules')):
-            dist_file_tar = os.path.join(self.code_path, tar_base + '.tar')
-
-            sh(['git', 'archive', '--worktree-attributes',
+        dist_file_tar = os.path.join(self.code_path, tar_base + '.tar')
+
+        # The archive of the project and the archives of its submodules are
+        # merged into a single archive that only depends on the committed
+        # contents
+        os.makedirs(self.paths.build_pkg_path, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=self.paths.build_pkg_path) as tmp_path:
+            sh(['git', 'archive', '--worktree-attributes', '--format=tar',
                 '--prefix=' + tar_base + '/', 'HEAD',
-                '-o', dist_file_tar],
+                '-o', os.path.join(tmp_path, '.main.tar')],
                cwd=self.code_path)
 
-            sh(['git', 'submodule', 'foreach', '--recursive',
-                f"git archive --worktree-attributes --prefix={tar_base + '/$path/'} " +
-                "--output=$sha1.tar HEAD && " +
-                f"tar --concatenate --file={os.path.abspath(dist_file_tar)} $sha1.tar && rm $sha1.tar"],
-                cwd=self.code_path)
+            # The archives are named after the paths of the submodules, with
+            # _ escaped as _u and / as _s so that the names don't collide
+            if os.path.isfile(os.path.join(self.code_path, '.gitmodules')):
+                sh(['git', 'submodule', 'foreach', '--quiet', '--recursive',
+                    f"git archive --worktree-attributes --prefix={tar_base}/$displaypath/ " +
+                    f"--output=\"{tmp_path}/$(printf %s \"$displaypath\" | " +
+                    "sed -e 's/_/_u/g' -e 's|/|_s|g').tar\" HEAD"],
+                   cwd=self.code_path)
 
-            # will automatically remove dist_file_tar and create dist_file
-            sh(['gzip', '-f', dist_file_tar], cwd=self.code_path)
-        else:
-            sh(['git', 'archive', '--worktree-attributes',
-                '--prefix=' + tar_base + '/', 'HEAD', '--format=tar.gz',
-                '-o', dist_file],
-               cwd=self.code_path)
+            source_tars = [os.path.join(tmp_path, '.main.tar')] + \
+                sorted(glob.glob(os.path.join(tmp_path, '*.tar')))
+            write_reproducible_tar(source_tars, dist_file_tar, self.get_source_date_epoch())
+
+        # -n keeps the file name and the time out of the gzip header. This
+        # will automatically remove dist_file_tar and create dist_file
+        sh(self.get_gzip_cmd(fast_compression) + ['-n', '-f', dist_file_tar], cwd=self.code_path)
 
         return (base, version, tar_base, 'tar.gz', dist_file)
 
@@ -652,18 +3088,16 @@ class Project:
                 return True
         return False
 
-    def make_distributable(self, use_dist=False):
-        dist_method = get_config_dist_method(self.proj_name)
+    def make_distributable(self, use_dist=False, fast_compression=False):
+        dist_method = get_config_dist_method(self.config, self.proj_name)
         if dist_method not in [None, 'git', 'autotools', 'makefile']:
-            out('ERROR: Unsupported distribution method {}'.format(dist_method))
-            sys.exit(1)
+            raise BuildError('Unsupported distribution method {}'.format(dist_method))
 
         # Make a distributable archive
         if not use_dist:
             if not self.vcs_type == VcsType.GIT:
-                out('ERROR: Must create distributable package when not using git sources')
-                sys.exit(1)
-            return self.make_distributable_git_archive()
+                raise BuildError('Must create distributable package when not using git sources')
+            return self.make_distributable_git_archive(fast_compression)
 
         if dist_method == 'autotools' or \
                 (dist_method is None and self.build_type == BuildType.AUTOTOOLS):
@@ -676,10 +3110,183 @@ class Project:
 
         if dist_method == 'git' or \
                 (dist_method is None and self.vcs_type == VcsType.GIT):
-            return self.make_distributable_git_archive()
+            return self.make_distributable_git_archive(fast_compression)
 
-        out('ERROR: VCS and project type not supported')
-        sys.exit(1)
+        raise BuildError('VCS and project type not supported')
+
+    # Returns the inputs that fully determine the outputs of a package build.
+    # Unless use_worktree is set, the sources of git projects are identified by
+    # the given refs because only committed state is packaged.
+    def get_package_inputs(self, use_worktree, refs=('HEAD^{tree}',), **options):
+        if self.vcs_type == VcsType.GIT and not use_worktree:
+            source = get_git_fingerprint(self.code_path, refs)
+        else:
+            source = get_dir_fingerprint(self.code_path)
+
+        debian_path = self.find_debian_folder()
+        inputs = {
+            'project': self.proj_name,
+            'source': source,
+            'debian': get_dir_fingerprint(debian_path) if debian_path is not None else None,
+            'dist_suite': self.paths.dist_suite,
+            'sign_key': get_config_debian_sign_key(self.config, self.proj_name),
+        }
+        inputs.update(options)
+        return inputs
+
+    # Returns the key of the project in BuildRecords
+    def get_build_record_key(self):
+        return os.path.relpath(self.code_path, self.paths.root_path)
+
+    # Returns the inputs of a pristine package build of the given version.
+    # Bare builds package the working tree and the original tarballs next to
+    # it, other builds the committed tree and the pristine-tar branch.
+    def get_pristine_package_inputs(self, name, version, bare):
+        orig_tars = sorted(glob.glob(os.path.join(self.code_path,
+                                                  self.get_orig_tar_glob(name, version))))
+        return self.get_package_inputs(
+            use_worktree=bare, refs=('HEAD^{tree}', 'pristine-tar'),
+            orig_tars=[get_file_digest(path) for path in orig_tars] if bare else None)
+
+    # Returns the fingerprint of the inputs of the project that are compared
+    # with BuildRecords. The inputs are the same as those of the package job
+    # built with the given options.
+    def get_build_record_fingerprint(self, pristine=False, bare=False, use_dist=False):
+        if pristine:
+            name, version, _ = self.extract_changelog_version(
+                os.path.join(self.code_path, 'debian'))
+            inputs = self.get_pristine_package_inputs(name, version, bare)
+        else:
+            inputs = self.get_package_inputs(use_worktree=use_dist)
+        return ArtifactCache.compute_key(dict(inputs, pristine=pristine))
+
+    # Returns the inputs of the artifact cache key that describe what a
+    # pbuilder build for arch links against besides the local projects: the
+    # base tgz and the local repository made available in the chroot
+    def get_pbuilder_inputs(self, job, arch):
+        if not job.use_pbuilder:
+            return {}
+        pbuilder_tgz = self.paths.get_pbuilder_tgz(arch)
+        inputs = {'base_tgz': None, 'local_repo': None}
+        if os.path.isfile(pbuilder_tgz):
+            st = os.stat(pbuilder_tgz)
+            inputs['base_tgz'] = [st.st_size, st.st_mtime]
+        if self.paths.local_repo is not None:
+            inputs['local_repo'] = self.paths.local_repo.get_fingerprint()
+        return inputs
+
+    def is_artifact_cache_enabled(self, use_cache):
+        return use_cache and get_config_artifact_cache(self.config, self.proj_name)
+
+    # Loads the checkpoints of the package build whose results go to
+    # persistent_path and computes the fingerprints of the phases from
+    # phase_inputs (see Checkpoints.compute_fingerprints()). The publishing
+    # phase is appended. If the job resumes an earlier run, finds the last
+    # completed phase.
+    def init_checkpoints(self, job, persistent_path, phase_inputs):
+        filename = os.path.relpath(persistent_path, self.paths.root_path).replace('/', '_')
+        job.checkpoints = Checkpoints(os.path.join(self.paths.checkpoint_path,
+                                                   filename + '.json'))
+        job.fingerprints = Checkpoints.compute_fingerprints(phase_inputs + [
+            (PackagePhase.PUBLISH, {'action': job.action.name if job.action else None}),
+        ])
+        if not job.resume:
+            return
+
+        phase, state = job.checkpoints.find_resume_point(job.fingerprints)
+        if phase is None:
+            out('No completed phases with identical inputs, starting from the beginning')
+            return
+        out('Resuming after the {0} phase'.format(phase.name.lower()))
+        job.resume_phase = phase
+        job.resume_state = state
+
+    # Restores the state of a job that resumes an earlier run. Build
+    # directories on the tmpfs are reused even if they exceed the budget, as
+    # their contents exist already. Returns whether the job resumes.
+    def resume_package_job(self, job, persistent_paths):
+        if job.resume_phase is None:
+            return False
+
+        state = job.resume_state
+        self.build_pkgver_path = state['build_pkgver_path']
+        job.result_path = state['result_path']
+        job.tar_file = state['tar_file']
+        job.tar_path = state['tar_path']
+        job.dsc_path = state['dsc_path']
+        job.arch_result_paths = state['arch_result_paths']
+
+        state_paths = [self.build_pkgver_path, job.result_path, job.tar_file, job.tar_path,
+                       job.dsc_path]
+        for persistent_path in persistent_paths:
+            staging_path = self.get_staging_path(persistent_path)
+            if staging_path is not None and \
+                    any(path is not None and (path + '/').startswith(staging_path + '/')
+                        for path in state_paths):
+                job.staging.append((staging_path, persistent_path, 0))
+        return True
+
+    def is_phase_done(self, job, phase):
+        return job.resume_phase is not None and phase.value <= job.resume_phase.value
+
+    # Returns the files and directories created by the given phase or earlier
+    # that the later phases need
+    def get_phase_outputs(self, job, phase):
+        if phase == PackagePhase.DISTRIBUTABLE:
+            return [job.tar_file]
+        if phase == PackagePhase.STAGING:
+            return [job.tar_file, job.tar_path]
+        if phase == PackagePhase.SOURCE:
+            if job.use_pbuilder:
+                return [job.dsc_path]
+            return [job.tar_path] if job.tar_path is not None else []
+        if phase == PackagePhase.BINARY:
+            result_paths = [job.result_path or self.build_pkgver_path]
+            result_paths += sorted(job.arch_result_paths.values())
+            return sorted(path for result_path in result_paths
+                          for path in glob.glob(os.path.join(result_path, '*.changes')))
+        return []
+
+    def record_phase(self, job, phase):
+        if job.checkpoints is None or phase not in job.fingerprints:
+            return
+
+        state = {
+            'build_pkgver_path': self.build_pkgver_path,
+            'result_path': job.result_path,
+            'tar_file': job.tar_file,
+            'tar_path': job.tar_path,
+            'dsc_path': job.dsc_path,
+            'arch_result_paths': job.arch_result_paths,
+        }
+        job.checkpoints.record(phase, job.fingerprints[phase],
+                               self.get_phase_outputs(job, phase), state)
+
+    # Returns the names of the build dependencies that the pbuilder build of
+    # this project will install
+    def get_pbuilder_build_depends(self, pristine, pbuilder_profiles=None):
+        metadata = self.get_packaging_metadata(pristine)
+        if metadata is None:
+            return []
+
+        profiles = set()
+        if pbuilder_profiles is not None:
+            profiles = set(pbuilder_profiles.replace(',', ' ').split())
+        return metadata.get_build_depends_names(self.paths.arch, profiles)
+
+    # Returns the DebianMetadata of the packaging of the project or None if
+    # the project has no usable debian directory
+    def get_packaging_metadata(self, pristine):
+        if pristine:
+            deb_folder = os.path.join(self.code_path, 'debian')
+        else:
+            deb_folder = self.find_debian_folder()
+        if deb_folder is None or not os.path.isdir(deb_folder):
+            return None
+        try:
+            return self.get_debian_metadata(deb_folder)
+        except BuildError:
+            return None
 
     def get_pkgver_dirname(self, version, arch):
         parts = [version, self.paths.dist_suite]
@@ -688,72 +3295,259 @@ class Project:
         return '_'.join(parts)
 
     def package(self, do_source=False, do_check=True, use_dist=False, use_pbuilder=False,
-                arch=None, pbuilder_profiles=None):
-        if use_pbuilder:
+                arch=None, pbuilder_profiles=None, use_cache=True, fast_compression=False):
+        job = PackageJob(do_source=do_source, do_check=do_check, use_dist=use_dist,
+                         use_pbuilder=use_pbuilder, arch=arch,
+                         pbuilder_profiles=pbuilder_profiles, use_cache=use_cache,
+                         fast_compression=fast_compression)
+        for stage in [PackageStage.DISTRIBUTABLE, PackageStage.SOURCE, PackageStage.BINARY]:
+            self.run_package_stage(job, stage)
+
+    def run_package_stage(self, job, stage):
+        succeeded = False
+        try:
+            with self.phase_context(stage.name.lower()):
+                self.run_package_stage_impl(job, stage)
+            succeeded = True
+        finally:
+            if not succeeded:
+                self.abort_staging(job)
+
+    def run_package_stage_impl(self, job, stage):
+        if stage == PackageStage.DISTRIBUTABLE:
+            if job.pristine:
+                self.prepare_pristine(job)
+            else:
+                self.prepare_distributable(job)
+            return
+
+        if job.restored:
+            if stage == PackageStage.BINARY:
+                self.add_to_local_repo(job)
+            return
+
+        if stage == PackageStage.SOURCE:
+            if self.is_phase_done(job, PackagePhase.SOURCE):
+                return
+            if job.pristine:
+                self.package_pristine_source(job)
+            else:
+                self.package_source(job)
+            self.record_phase(job, PackagePhase.SOURCE)
+        elif stage == PackageStage.BINARY:
+            if self.is_phase_done(job, PackagePhase.BINARY):
+                self.add_to_local_repo(job)
+                return
+            if job.pristine:
+                self.package_pristine_binary(job)
+            else:
+                self.package_binary(job)
+
+            self.finish_staging(job)
+            if job.cache_key is not None:
+                self.artifact_cache.store(job.cache_key, job.result_path, self.proj_name)
+            self.record_phase(job, PackagePhase.BINARY)
+            self.add_to_local_repo(job)
+
+    # Makes the packages of the job available to the pbuilder builds of the
+    # following projects if the local repository holds the results of the run
+    def add_to_local_repo(self, job):
+        local_repo = self.paths.local_repo
+        if local_repo is None or local_repo.mode != 'run':
+            return
+        dirs = list(job.arch_result_paths.values())
+        if not dirs:
+            dirs = [job.result_path or self.build_pkgver_path]
+        local_repo.add([d for d in dirs if d is not None and os.path.isdir(d)])
+
+    # Builds the source tree if requested, creates the distributable and
+    # extracts it into a clean packaging build directory along with the debian
+    # directory
+    def prepare_distributable(self, job):
+        if job.use_pbuilder:
             out(f'Packaging project \'{self.proj_name}\' using pbuilder')
         else:
             out(f'Packaging project \'{self.proj_name}\'')
 
-        if do_source and use_pbuilder:
+        if job.do_source and job.use_pbuilder:
             raise Exception("package: do_source and use_pbuilder are incompatible")
 
-        base, version, tar_base, ext, dist_file = self.make_distributable(use_dist=use_dist)
+        debian_path = self.find_debian_folder()
+        _, version, _ = self.extract_changelog_version(debian_path)
+        build_arch = self.paths.arch if job.use_pbuilder else resolve_architecture(job.arch)
+        if job.arches is not None:
+            build_arch = job.arches
+        pkgver_path = os.path.join(self.build_pkg_path,
+                                   self.get_pkgver_dirname(version, job.arch))
+        self.protect_path(pkgver_path)
+
+        inputs = self.get_package_inputs(use_worktree=job.use_dist)
+        self.init_checkpoints(job, pkgver_path, [
+            (PackagePhase.DISTRIBUTABLE, {
+                'project': inputs['project'],
+                'source': inputs['source'],
+                'changelog': get_file_digest(os.path.join(debian_path, 'changelog')),
+                'dist_suite': inputs['dist_suite'],
+                'arch': job.arch,
+                'use_dist': job.use_dist,
+                'fast_compression': job.fast_compression,
+            }),
+            (PackagePhase.STAGING, {'debian': inputs['debian']}),
+            (PackagePhase.SOURCE, {'sign_key': inputs['sign_key'], 'do_source': job.do_source,
+                                   'do_check': job.do_check, 'use_pbuilder': job.use_pbuilder}),
+            (PackagePhase.BINARY, {'arch': build_arch,
+                                   'pbuilder_profiles': job.pbuilder_profiles}),
+        ])
+
+        # The artifact cache holds the results of a single build directory, so
+        # builds for multiple architectures are not cached
+        if self.is_artifact_cache_enabled(job.use_cache) and job.arches is None:
+            job.cache_key = self.artifact_cache.compute_key(dict(
+                inputs, do_source=job.do_source, do_check=job.do_check,
+                use_dist=job.use_dist, use_pbuilder=job.use_pbuilder, arch=build_arch,
+                pbuilder_profiles=job.pbuilder_profiles, fast_compression=job.fast_compression,
+                build_depends=job.dependency_fingerprints,
+                **self.get_pbuilder_inputs(job, build_arch)))
+
+        if not self.resume_package_job(job, [pkgver_path]):
+            self.build(job.do_build)
+            self.check_build(job.do_build and job.do_check_build)
+
+            if job.cache_key is not None and \
+                    self.artifact_cache.restore(job.cache_key, pkgver_path):
+                out('Reusing packages from an earlier build with identical inputs')
+                self.build_pkgver_path = pkgver_path
+                job.restored = True
+                self.record_phase(job, PackagePhase.BINARY)
+                return
+
+            self.make_package_distributable(job, pkgver_path)
+
+        if not self.is_phase_done(job, PackagePhase.STAGING):
+            self.extract_distributable(job)
+
+    # Creates the distributable and moves it into a clean packaging build
+    # directory
+    def make_package_distributable(self, job, pkgver_path):
+        base, version, tar_base, ext, dist_file = self.make_distributable(
+            use_dist=job.use_dist, fast_compression=job.fast_compression)
 
         out('File: {0}'.format(dist_file))
         out('Name: {0}; version: {1}'.format(base, version))
         out('Tar-dir: {0}'.format(tar_base))
 
-        self.build_pkgver_path = os.path.join(self.build_pkg_path,
-                                              self.get_pkgver_dirname(version, arch))
-        tar_file = '{0}/{1}_{2}.orig.{3}'.format(self.build_pkgver_path, base,
-                                                 version, ext)
-        tar_path = os.path.join(self.build_pkgver_path, tar_base)
+        self.build_pkgver_path = self.allocate_staging(job, pkgver_path)
+        job.result_path = self.build_pkgver_path
+        job.tar_file = '{0}/{1}_{2}.orig.{3}'.format(self.build_pkgver_path, base,
+                                                     version, ext)
+        job.tar_path = os.path.join(self.build_pkgver_path, tar_base)
 
         # create a clean build dir
         if os.path.isdir(self.build_pkgver_path):
-            shutil.rmtree(self.build_pkgver_path)
+            self.paths.trash.remove(self.build_pkgver_path)
         os.makedirs(self.build_pkgver_path)
 
-        # Move the distributable to the destination directory and cleanly
-        # extract it
-        shutil.move(dist_file, tar_file)
+        # Move the distributable to the destination directory
+        shutil.move(dist_file, job.tar_file)
+        self.record_phase(job, PackagePhase.DISTRIBUTABLE)
+
+    # Cleanly extracts the distributable and imports the debian directory
+    def extract_distributable(self, job):
+        tar_file = job.tar_file
+        tar_path = job.tar_path
+        if os.path.isdir(tar_path):
+            self.paths.trash.remove(tar_path)
         sh(['tar', '-xf', tar_file, '-C', self.build_pkgver_path],
            cwd=self.build_pkgver_path)
 
         # Check if successful
         if not os.path.isdir(tar_path):
-            out("ERROR: Failed to extract distributable archive to " + tar_path)
-            sys.exit(1)
+            raise BuildError("Failed to extract distributable archive to " + tar_path)
 
         # Import debian config folder
         self.import_debian_dir(tar_file, tar_path)
 
-        # Make debian package
-        if use_pbuilder:
+        base, version, deb_version = \
+            self.extract_changelog_version(self.find_debian_folder())
+        job.dsc_path = os.path.join(self.build_pkgver_path,
+                                    self.compute_dsc_filename(base, version, deb_version))
+        self.record_phase(job, PackagePhase.STAGING)
+
+    def package_source(self, job):
+        if job.use_pbuilder or job.arches is not None:
             # Note that the architecture is None to use host architecture for source package build
-            self.debuild(tar_path, True, do_check, None)
-
-            _, __, deb_version = \
-                self.extract_changelog_version(self.find_debian_folder())
-            dsc_filename = self.compute_dsc_filename(base, version, deb_version)
-            dsc_path = os.path.join(self.build_pkgver_path, dsc_filename)
-            self.run_pbuilder_for_dsc(dsc_path, self.build_pkgver_path,
-                                      pbuilder_profiles=pbuilder_profiles)
+            self.debuild(job.tar_path, True, job.do_check, None)
+
+    def package_binary(self, job):
+        if job.arches is not None:
+            self.package_binary_arches(job)
+        elif job.use_pbuilder:
+            self.run_pbuilder_for_dsc(job.dsc_path, self.build_pkgver_path,
+                                      pbuilder_profiles=job.pbuilder_profiles,
+                                      fast_compression=job.fast_compression)
         else:
-            self.debuild(tar_path, do_source, do_check, arch)
+            self.debuild(job.tar_path, job.do_source, job.do_check, job.arch,
+                         fast_compression=job.fast_compression)
+
+    # Builds the binary packages for each of the architectures of the job
+    # concurrently from the source package
+    def package_binary_arches(self, job):
+        _, version, _ = self.extract_changelog_version(self.find_debian_folder())
+        with ThreadPoolExecutor(max_workers=len(job.arches)) as executor:
+            futures = [executor.submit(self.package_binary_arch, job, version, arch)
+                       for arch in job.arches]
+            for future in futures:
+                future.result()
+
+        host_arch = resolve_architecture(None)
+        self.build_pkgver_path = job.arch_result_paths.get(
+            host_arch, job.arch_result_paths[job.arches[0]])
+
+    def package_binary_arch(self, job, version, arch):
+        with self.phase_context('binary-' + arch):
+            pkgver_path = os.path.join(self.build_pkg_path,
+                                       self.get_pkgver_dirname(version, arch))
+            self.protect_path(pkgver_path)
+            build_path = self.allocate_staging(job, pkgver_path)
+            self.clean_path(build_path)
+
+            out('Building binary packages of \'{0}\' for {1}'.format(self.proj_name, arch))
+            if job.use_pbuilder:
+                self.run_pbuilder_for_dsc(job.dsc_path, build_path,
+                                          pbuilder_profiles=job.pbuilder_profiles,
+                                          fast_compression=job.fast_compression, arch=arch)
+            else:
+                tar_path = os.path.join(build_path, os.path.basename(job.tar_path))
+                sh(['dpkg-source', '-x', job.dsc_path, tar_path], cwd=build_path)
+                self.debuild(tar_path, False, job.do_check, arch,
+                             fast_compression=job.fast_compression, binary_only=True)
+            job.arch_result_paths[arch] = pkgver_path
+
+    # Returns the environment that makes dpkg-deb use fast compression
+    def get_deb_compression_env(self, fast_compression):
+        if not fast_compression:
+            return {}
+        return {
+            'DPKG_DEB_COMPRESSOR_TYPE': get_config_fast_deb_compressor(self.config, self.proj_name),
+            'DPKG_DEB_COMPRESSOR_LEVEL': str(get_config_fast_compression_level(self.config,
+                                                                               self.proj_name)),
+            'DPKG_DEB_THREADS_MAX': str(get_config_cpu_cores(self.config, self.proj_name)),
+        }
 
     # Returns arguments for dpkg package signing utility
     def get_key_args(self):
-        key = get_config_debian_sign_key(self.proj_name)
-        if key is None:
+        key = get_config_debian_sign_key(self.config, self.proj_name)
+        if key is None or self.paths.signing_queue is not None:
+            # Packages are signed by the signing queue at the end of the run
             return ['-us', '-uc']
         return ['-k' + key]
 
     # Runs debuild in the tar_path directory
-    def debuild(self, tar_path, do_source, do_check, arch):
+    def debuild(self, tar_path, do_source, do_check, arch, fast_compression=False,
+                binary_only=False):
         key_args = self.get_key_args()
 
-        num_cores = get_config_cpu_cores(self.proj_name)
+        num_cores = get_config_cpu_cores(self.config, self.proj_name)
 
         cmd = ['debuild', '--prepend-path=/usr/lib/ccache']
 
@@ -773,38 +3567,71 @@ class Project:
             cmd += [
                 '-eDEB_BUILD_PROFILES=' + ' '.join(build_profiles),
             ]
+        for name, value in self.get_deb_compression_env(fast_compression).items():
+            cmd += ['-e{0}={1}'.format(name, value)]
 
         if arch is not None:
             cmd += [f'-a{arch}']
 
         if do_source is True:
-            r = sh(cmd + ['-S', '-sa', '-d'] + key_args,
-                   cwd=tar_path)
+            sh(cmd + ['-S', '-sa', '-d'] + key_args,
+               cwd=tar_path)
+        elif binary_only:
+            sh(cmd + ['-b'] + key_args, cwd=tar_path)
         else:
-            r = sh(cmd + ['-sa'] + key_args, cwd=tar_path)
-        if r != 0:
-            out("ERROR: Building project {0} failed".format(self.proj_name))
-            sys.exit(1)
+            sh(cmd + ['-sa'] + key_args, cwd=tar_path)
 
     def clean_path(self, path):
         if os.path.isdir(path):
-            shutil.rmtree(path)
+            self.paths.trash.remove(path)
         os.makedirs(path)
 
     def compute_dsc_filename(self, name, version, deb_version):
         return '{0}_{1}-{2}.dsc'.format(name, version, deb_version)
 
-    def run_pbuilder_for_dsc(self, dsc_path, build_path, pbuilder_profiles=None):
+    def run_pbuilder_for_dsc(self, dsc_path, build_path, pbuilder_profiles=None,
+                             fast_compression=False, arch=None):
         out("Using dsc: \'{0}\'".format(dsc_path))
         if not os.path.isfile(dsc_path):
-            out("ERROR: Could not find .dsc file")
-            sys.exit(1)
+            raise BuildError("Could not find .dsc file")
+
+        if arch is None:
+            arch = self.paths.arch
+        pbuilder_tgz = self.paths.get_pbuilder_tgz(arch)
+        if not os.path.isfile(pbuilder_tgz):
+            raise BuildError("No pbuilder environment for {0}, run --create-pbuilder "
+                             "--arch {0} first".format(arch))
+
+        buildplace = self.paths.pbuilder_workdir_path
+        staging = self.paths.tmpfs_staging
+        staging_size = 0
+        config_lines = []
+        if staging is not None:
+            size = self.estimate_build_size()
+            size += 4 * os.path.getsize(pbuilder_tgz)
+            if staging.reserve(size):
+                staging_size = size
+                buildplace = staging.get_path('pbuilder')
+                os.makedirs(buildplace, exist_ok=True)
+                # The apt cache is on a different file system, so it can't be
+                # hardlinked
+                config_lines.append('APTCACHEHARDLINK=no')
+
+        for name, value in self.get_deb_compression_env(fast_compression).items():
+            config_lines.append('export {0}={1}'.format(name, value))
+        if self.paths.local_repo is not None:
+            config_lines += self.paths.local_repo.get_pbuilder_config_lines()
+
+        config_args = []
+        if config_lines:
+            config_args = ['--configfile', get_pbuilderrc(self.paths, config_lines)]
 
         cmd = [
             'sudo', 'pbuilder', 'build',
-            '--buildplace', self.paths.pbuilder_workdir_path,
-            '--basetgz', self.paths.pbuilder_tgz,
-            '--architecture', self.paths.arch,
+        ] + config_args + [
+            '--buildplace', buildplace,
+            '--basetgz', pbuilder_tgz,
+            '--architecture', arch,
             '--mirror', self.paths.pbuilder_mirror,
         ]
         cmd += get_pbuilder_othermirror_opt(self.paths.pbuilder_othermirror)
@@ -818,11 +3645,22 @@ class Project:
             '--buildresult', build_path,
             dsc_path,
         ]
-        sh(cmd, cwd=self.paths.build_pbuilder_path)
+        try:
+            sh(cmd, cwd=self.paths.build_pbuilder_path)
+        finally:
+            if staging_size:
+                staging.release(staging_size)
 
     def package_pristine(self, do_source=False, use_pbuilder=False, bare=False,
-                         pbuilder_profiles=None):
-        if not use_pbuilder:
+                         pbuilder_profiles=None, use_cache=True, fast_compression=False):
+        job = PackageJob(pristine=True, bare=bare, do_source=do_source,
+                         use_pbuilder=use_pbuilder, pbuilder_profiles=pbuilder_profiles,
+                         use_cache=use_cache, fast_compression=fast_compression)
+        for stage in [PackageStage.DISTRIBUTABLE, PackageStage.SOURCE, PackageStage.BINARY]:
+            self.run_package_stage(job, stage)
+
+    def prepare_pristine(self, job):
+        if not job.use_pbuilder:
             out("Packaging pristine sources")
         else:
             out("Packaging pristine sources with pbuilder")
@@ -830,9 +3668,8 @@ class Project:
 
         # check is deb_dir exists
         if not os.path.isdir(deb_dir):
-            out("ERROR: No debian directory for project \'{0}\'".format(
-                self.proj_name))
-            sys.exit(1)
+            raise BuildError("No debian directory for project \'{0}\'".format(
+                             self.proj_name))
 
         (name, version, deb_version) = self.extract_changelog_version(deb_dir)
 
@@ -840,73 +3677,319 @@ class Project:
 
         build_path = self.build_pkgver_path
         src_build_path = build_path + '_source'
+        self.protect_path(build_path)
+        self.protect_path(src_build_path)
+
+        job.dsc_path = os.path.join(src_build_path,
+                                    self.compute_dsc_filename(name, version, deb_version))
+
+        # Only builds that place their results into a directory of their own
+        # can be cached. Bare source packages are placed next to the sources.
+        if job.use_pbuilder or not job.do_source:
+            job.result_path = build_path
+        elif not job.bare:
+            job.result_path = src_build_path
+
+        inputs = self.get_pristine_package_inputs(name, version, job.bare)
+        self.init_checkpoints(job, build_path, [
+            (PackagePhase.SOURCE, dict(inputs, do_source=job.do_source, bare=job.bare)),
+            (PackagePhase.BINARY, {'use_pbuilder': job.use_pbuilder, 'arch': self.paths.arch,
+                                   'pbuilder_profiles': job.pbuilder_profiles,
+                                   'fast_compression': job.fast_compression}),
+        ])
+        if self.resume_package_job(job, [build_path, src_build_path]):
+            return
 
-        key_args = self.get_key_args()
+        if job.result_path is not None and self.is_artifact_cache_enabled(job.use_cache):
+            job.cache_key = self.artifact_cache.compute_key(dict(
+                inputs, do_source=job.do_source, use_pbuilder=job.use_pbuilder,
+                arch=self.paths.arch, pbuilder_profiles=job.pbuilder_profiles,
+                fast_compression=job.fast_compression,
+                build_depends=job.dependency_fingerprints,
+                **self.get_pbuilder_inputs(job, self.paths.arch)))
+
+            if self.artifact_cache.restore(job.cache_key, job.result_path):
+                out('Reusing packages from an earlier build with identical inputs')
+                job.restored = True
+                self.record_phase(job, PackagePhase.BINARY)
+                return
+
+        # Only the directories that the job writes to are staged, as staging
+        # replaces the contents of the persistent directories
+        if job.use_pbuilder or not job.do_source:
+            self.build_pkgver_path = self.allocate_staging(job, build_path)
+            if job.result_path == build_path:
+                job.result_path = self.build_pkgver_path
+        # Bare source packages are placed next to the sources
+        if (job.do_source or job.use_pbuilder) and not job.bare:
+            staging_src_build_path = self.allocate_staging(job, src_build_path)
+            if job.result_path == src_build_path:
+                job.result_path = staging_src_build_path
+            job.dsc_path = os.path.join(staging_src_build_path, os.path.basename(job.dsc_path))
+
+    def get_orig_tar_glob(self, name, version):
+        return '../{0}_{1}.orig.tar.*'.format(name, version)
+
+    def package_pristine_source(self, job):
+        if not job.do_source and not job.use_pbuilder:
+            return
 
-        if do_source or use_pbuilder:
-            self.clean_path(src_build_path)
+        src_build_path = os.path.dirname(job.dsc_path)
+        self.clean_path(src_build_path)
 
-            dsc_filename = self.compute_dsc_filename(name, version, deb_version)
+        if job.bare:
+            name, version, _ = self.extract_changelog_version(
+                os.path.join(self.code_path, 'debian'))
+            filename_glob = self.get_orig_tar_glob(name, version)
+            orig_tars = glob.glob(os.path.join(self.code_path, filename_glob))
 
-            if bare:
-                filename_glob = '../{0}_{1}.orig.tar.*'.format(name, version)
-                orig_tars = glob.glob(os.path.join(self.code_path, filename_glob))
+            out('Found the following tags matching {}:'.format(filename_glob))
+            for path in orig_tars:
+                out(path)
 
-                out('Found the following tags matching {}:'.format(filename_glob))
-                for path in orig_tars:
-                    out(path)
+            if len(orig_tars) == 0:
+                raise BuildError("no original tars found and bare was requested")
 
-                if len(orig_tars) == 0:
-                    out("ERROR: no original tars found and bare was requested")
-                    sys.exit(1)
+            out('Packaging bare sources without VCS')
+            sh(['dpkg-source', '-b', '.'], cwd=self.code_path)
+            job.dsc_path = os.path.join(self.code_path, '..', os.path.basename(job.dsc_path))
+        else:
+            self.gbp_buildpackage_pristine(src_build_path, ['-S', '-sa'])
 
-                out('Packaging bare sources without VCS')
-                sh(['dpkg-source', '-b', '.'], cwd=self.code_path)
-                dsc_path = os.path.join(self.code_path, '..', dsc_filename)
-            else:
-                sh(['gbp', 'buildpackage', '--git-pristine-tar',
-                    '--git-export-dir=' + src_build_path,
-                    '-S', '-sa'] + key_args, cwd=self.code_path)
-                dsc_path = os.path.join(src_build_path, dsc_filename)
+    def package_pristine_binary(self, job):
+        build_path = self.build_pkgver_path
+        if job.use_pbuilder:
+            self.clean_path(build_path)
+            self.run_pbuilder_for_dsc(job.dsc_path, build_path,
+                                      pbuilder_profiles=job.pbuilder_profiles,
+                                      fast_compression=job.fast_compression)
+        elif not job.do_source:
+            self.clean_path(build_path)
+            args = ['-sa']
+            if job.fast_compression:
+                # debuild, the default builder of gbp, only passes on the
+                # environment variables given with -e
+                builder = ['debuild', '-i', '-I'] + [
+                    '-e{0}={1}'.format(name, value)
+                    for name, value in self.get_deb_compression_env(True).items()]
+                args = ['--git-builder=' + ' '.join(shlex.quote(arg) for arg in builder)] + args
+            self.gbp_buildpackage_pristine(build_path, args)
+
+    # Builds the pristine sources with gbp in the worktree of the current
+    # version and copies the results to dest_path. The orig tarballs are taken
+    # from the cache of regenerated pristine-tar tarballs.
+    #
+    # The worktree is kept on disk between builds so that only changed files
+    # are checked out. If dest_path is staged on the tmpfs, the worktree is
+    # placed on the tmpfs too, within the space reserved for the staged build,
+    # and removed afterwards. Such builds check out the whole tree again.
+    def gbp_buildpackage_pristine(self, dest_path, args):
+        name, version, _ = self.extract_changelog_version(os.path.join(self.code_path, 'debian'))
+        orig_path = self.get_pristine_orig_path(name, version)
+
+        staging = self.paths.tmpfs_staging
+        staged = staging is not None and \
+            dest_path.startswith(staging.get_path('packaging') + '/')
+        if staged:
+            proj_tree_path = staging.get_path('pristine_trees', self.proj_name)
+        else:
+            proj_tree_path = os.path.join(self.paths.pristine_tree_path, self.proj_name)
+        tree_path = self.update_pristine_worktree(proj_tree_path, name, version)
+
+        try:
+            cmd = ['gbp', 'buildpackage', '--git-pristine-tar', '--git-ignore-branch']
+            if orig_path is not None:
+                cmd += ['--git-tarball-dir=' + orig_path]
+            sh(cmd + args + self.get_key_args(), cwd=tree_path)
+
+            self.clean_path(dest_path)
+            results_path = os.path.dirname(tree_path)
+            for fn in os.listdir(results_path):
+                path = os.path.join(results_path, fn)
+                if ArtifactCache.is_artifact(fn) and os.path.isfile(path):
+                    ArtifactCache.link_or_copy(os.path.realpath(path),
+                                               os.path.join(dest_path, fn))
+        finally:
+            if staged:
+                self.paths.trash.remove(proj_tree_path)
+                sh(['git', 'worktree', 'prune'], cwd=self.code_path)
+
+    # Returns the directory with the orig tarballs of the given version as
+    # regenerated from the pristine-tar branch, or None if the branch has no
+    # data for the version. The tarballs are cached by the pristine-tar data
+    # that they are generated from, i.e. the tarball delta and the upstream
+    # commit, so they are only regenerated when a new upstream version is
+    # imported.
+    def get_pristine_orig_path(self, name, version):
+        r = get_command_engine().run(['git', 'ls-tree', 'pristine-tar'], cwd=self.code_path,
+                                     check=False, capture=True)
+        if not r.succeeded():
+            return None
 
-            if use_pbuilder:
-                self.clean_path(build_path)
-                self.run_pbuilder_for_dsc(dsc_path, build_path, pbuilder_profiles=pbuilder_profiles)
+        prefix = '{0}_{1}.orig'.format(name, version)
+        entries = sorted(line for line in r.output.splitlines()
+                         if line.split('\t', 1)[-1].startswith(prefix))
+        tarballs = [line.split('\t', 1)[1][:-len('.delta')] for line in entries
+                    if line.endswith('.delta')]
+        if not tarballs:
+            return None
 
-        else:
-            self.clean_path(build_path)
-            sh(['gbp', 'buildpackage', '--git-pristine-tar',
-                '--git-export-dir=', build_path, '-sa'] + key_args,
+        cache_path = os.path.join(self.paths.orig_cache_path,
+                                  ArtifactCache.compute_key({'pristine_tar': entries}))
+        self.protect_path(cache_path)
+        if os.path.isdir(cache_path):
+            out('Reusing orig tarballs regenerated from pristine-tar')
+            os.utime(cache_path)
+            return cache_path
+
+        tmp_path = '{0}.tmp-{1}'.format(cache_path, os.getpid())
+        self.protect_path(tmp_path)
+        self.clean_path(tmp_path)
+        for tarball in tarballs:
+            sh(['pristine-tar', 'checkout', os.path.join(tmp_path, tarball)],
                cwd=self.code_path)
+        try:
+            os.rename(tmp_path, cache_path)
+        except OSError:
+            # Regenerated by another process in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return cache_path
+
+    # Updates the git worktree under proj_tree_path in which the pristine
+    # sources of the given version are built to the HEAD of the project.
+    # Unlike a fresh export, only the files that have changed since the
+    # previous build are rewritten. The results of earlier builds and the
+    # worktrees of other versions are removed. Returns the path of the
+    # worktree.
+    def update_pristine_worktree(self, proj_tree_path, name, version):
+        results_path = os.path.join(proj_tree_path, version)
+        tree_path = os.path.join(results_path, '{0}-{1}'.format(name, version))
+
+        if os.path.isdir(proj_tree_path):
+            for fn in os.listdir(proj_tree_path):
+                if fn != version:
+                    self.paths.trash.remove(os.path.join(proj_tree_path, fn))
+                    sh(['git', 'worktree', 'prune'], cwd=self.code_path)
+
+        head = get_command_engine().run(['git', 'rev-parse', 'HEAD'], cwd=self.code_path,
+                                        capture=True).output.strip()
+        if os.path.isfile(os.path.join(tree_path, '.git')):
+            sh(['git', 'checkout', '--quiet', '--force', '--detach', head], cwd=tree_path)
+            sh(['git', 'clean', '-q', '-f', '-d', '-x'], cwd=tree_path)
+        else:
+            self.paths.trash.remove(tree_path)
+            os.makedirs(results_path, exist_ok=True)
+            sh(['git', 'worktree', 'prune'], cwd=self.code_path)
+            sh(['git', 'worktree', 'add', '--detach', tree_path, head], cwd=self.code_path)
+
+        for fn in os.listdir(results_path):
+            path = os.path.join(results_path, fn)
+            if os.path.isfile(path) or os.path.islink(path):
+                os.remove(path)
+        return tree_path
 
     def get_latest_pkgver(self):
         versions = []
         for d in os.listdir(self.build_pkg_path):
             d = os.path.join(self.build_pkg_path, d)
-            if os.path.isdir(d):
+            if os.path.isdir(d) and not os.path.islink(d):
                 versions.append(d)
 
         return max(versions, key=os.path.getmtime)
 
+    # Writes the manifest of the packaging build directory listing the
+    # artifacts in it along with their sizes and digests. Returns the manifest.
+    def write_manifest(self, pkgver_path):
+        artifacts = []
+        for fn in sorted(os.listdir(pkgver_path)):
+            path = os.path.join(pkgver_path, fn)
+            if ArtifactCache.is_artifact(fn) and os.path.isfile(path):
+                artifacts.append({'name': fn,
+                                  'size': os.path.getsize(path),
+                                  'sha256': get_file_digest(path)})
+        manifest = {
+            'project': self.proj_name,
+            'path': pkgver_path,
+            'artifacts': artifacts,
+        }
+
+        manifest_path = os.path.join(pkgver_path, 'manifest.json')
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(manifest_path + '.tmp', manifest_path)
+        return manifest
+
+    # Returns the manifest of the packaging build directory. Directories built
+    # before manifests were introduced get one.
+    def read_manifest(self, pkgver_path):
+        try:
+            with open(os.path.join(pkgver_path, 'manifest.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return self.write_manifest(pkgver_path)
+
+    # Records the packaging build directories of the last successful package
+    # run of the project. host_path is the one with the packages that can be
+    # installed into the system.
+    def write_latest(self, pkgver_paths, host_path):
+        latest = {'paths': pkgver_paths, 'host_path': host_path}
+        latest_path = os.path.join(self.build_pkg_path, 'latest.json')
+        with open(latest_path + '.tmp', 'w') as f:
+            json.dump(latest, f, indent=2)
+        os.replace(latest_path + '.tmp', latest_path)
+
+    # Returns the (pkgver_paths, host_path) tuple recorded by write_latest().
+    # Falls back to the most recently modified packaging build directory.
+    def read_latest(self):
+        try:
+            with open(os.path.join(self.build_pkg_path, 'latest.json')) as f:
+                latest = json.load(f)
+            if all(os.path.isdir(path) for path in latest['paths']):
+                return latest['paths'], latest['host_path']
+        except (OSError, ValueError, KeyError):
+            pass
+        path = self.get_latest_pkgver()
+        return [path], path
+
+    @project_phase('publish')
     def install(self):
         # Install the package(s)
         if self.build_pkgver_path is None:
-            self.build_pkgver_path = self.get_latest_pkgver()
-
-        # TODO: switch to fnmatch
-        sh('pkg=$(echo *.deb); /usr/lib/x86_64-linux-gnu/libexec/kf5/kdesu -t -c "dpkg -i $pkg"',
+            _, self.build_pkgver_path = self.read_latest()
+
+        manifest = self.read_manifest(self.build_pkgver_path)
+        debs = [shlex.quote(os.path.join(self.build_pkgver_path, artifact['name']))
+                for artifact in manifest['artifacts'] if artifact['name'].endswith('.deb')]
+        if not debs:
+            raise BuildError('No packages in ' + self.build_pkgver_path)
+        sh(['/usr/lib/x86_64-linux-gnu/libexec/kf5/kdesu', '-t', '-c',
+            'dpkg -i ' + ' '.join(debs)],
            cwd=self.build_pkgver_path)
 
-    def debinstall(self):
-        if self.build_pkgver_path is None:
-            self.build_pkgver_path = self.get_latest_pkgver()
+    # Copies the packages to the local repository. pkgver_paths are the
+    # packaging build directories to take the packages from and default to
+    # those of the last package run. Packages that are already in the
+    # repository with identical contents are not copied again.
+    @project_phase('publish')
+    def debinstall(self, pkgver_paths=None):
+        if pkgver_paths is None:
+            if self.build_pkgver_path is None:
+                pkgver_paths, self.build_pkgver_path = self.read_latest()
+            else:
+                pkgver_paths = [self.build_pkgver_path]
 
         # Install the package(s)
-        debs = os.listdir(self.build_pkgver_path)
-        for deb in debs:
-            if deb.endswith('.deb'):
-                shutil.copyfile(os.path.join(self.build_pkgver_path, deb),
-                                os.path.join(self.paths.archive_path, deb))
+        for pkgver_path in pkgver_paths:
+            for artifact in self.read_manifest(pkgver_path)['artifacts']:
+                deb = artifact['name']
+                if not deb.endswith('.deb'):
+                    continue
+                dest_path = os.path.join(self.paths.archive_path, deb)
+                if os.path.isfile(dest_path) and \
+                        os.path.getsize(dest_path) == artifact['size'] and \
+                        get_file_digest(dest_path) == artifact['sha256']:
+                    continue
+                shutil.copyfile(os.path.join(pkgver_path, deb), dest_path)
         sh(['./reload'], cwd=self.paths.archive_path)
 
 
@@ -959,6 +4042,168 @@ def print_available_projects(project_dirs, deb_project_dirs):
         out('\'{0}\' in directory \'{1}\''.format(p, d))
 
 
+# Returns a dict that maps the name of each project to the set of names of the
+# given projects that it build-depends on
+def get_project_dependencies(projects, pristine):
+    metadata = {pr.proj_name: pr.get_packaging_metadata(pristine) for pr in projects}
+
+    providers = {}
+    for proj_name, md in metadata.items():
+        if md is not None:
+            for pkg in md.binary_packages:
+                providers[pkg] = proj_name
+
+    dependencies = {}
+    for proj_name, md in metadata.items():
+        dependencies[proj_name] = set()
+        if md is None:
+            continue
+        for alternatives in md.build_depends:
+            for relation in alternatives:
+                provider = providers.get(relation.name, None)
+                if provider is not None and provider != proj_name:
+                    dependencies[proj_name].add(provider)
+    return dependencies
+
+
+# Returns a dict mapping the name of each of the projects to a dict that maps
+# the names of the local projects it build-depends on, directly or indirectly,
+# to their build record fingerprints. All available projects are considered,
+# not only the given ones, so that packages built against an older version of
+# a dependency are not restored from the artifact cache.
+def get_dependency_fingerprints(paths, projects, options):
+    available = {p: Project(paths, p, d) for d, p in get_available_projects(paths.project_dirs)}
+    for pr in projects:
+        available.setdefault(pr.proj_name, pr)
+    dependencies = get_project_dependencies(list(available.values()), options.pristine)
+
+    fingerprints = {}
+
+    def get_fingerprint(proj_name):
+        if proj_name not in fingerprints:
+            fingerprints[proj_name] = available[proj_name].get_build_record_fingerprint(
+                pristine=options.pristine, bare=options.pristine_bare,
+                use_dist=options.use_dist)
+        return fingerprints[proj_name]
+
+    result = {}
+    for pr in projects:
+        deps = set()
+        pending = list(dependencies.get(pr.proj_name, ()))
+        while pending:
+            dep = pending.pop()
+            if dep not in deps and dep != pr.proj_name:
+                deps.add(dep)
+                pending += dependencies.get(dep, ())
+        result[pr.proj_name] = {dep: get_fingerprint(dep) for dep in sorted(deps)}
+    return result
+
+
+# Returns the projects ordered so that each project comes after the projects
+# it build-depends on. Otherwise keeps the order of the projects.
+def sort_projects(projects, dependencies):
+    ordered = []
+    visited = set()
+
+    def visit(pr):
+        if pr.proj_name in visited:
+            return
+        visited.add(pr.proj_name)
+        for dep in sorted(dependencies.get(pr.proj_name, ())):
+            if dep in projects_by_name:
+                visit(projects_by_name[dep])
+        ordered.append(pr)
+
+    projects_by_name = {pr.proj_name: pr for pr in projects}
+    for pr in projects:
+        visit(pr)
+    return ordered
+
+
+class ProjectStatus(enum.Enum):
+    SUCCEEDED = 1
+    FAILED = 2
+    SKIPPED = 3
+
+
+class ProjectSkipped(Exception):
+    pass
+
+
+# Tracks the outcome of each project of a batch. In keep-going mode failures
+# are recorded instead of aborting the batch and the projects that depend on
+# a failed project are skipped.
+class BatchRunner:
+
+    def __init__(self, keep_going=False):
+        self.keep_going = keep_going
+        self.dependencies = {}
+        # Maps project name to (status, phase, message, log_file)
+        self.results = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def set_dependencies(self, dependencies):
+        self.dependencies = dependencies
+
+    # Raises ProjectSkipped if any dependency of the project has failed
+    def check_dependencies(self, pr):
+        with self.lock:
+            for dep in sorted(self.dependencies.get(pr.proj_name, ())):
+                result = self.results.get(dep, None)
+                if result is not None and result[0] != ProjectStatus.SUCCEEDED:
+                    raise ProjectSkipped('depends on {0}'.format(dep))
+
+    def record_success(self, pr):
+        with self.lock:
+            self.results[pr.proj_name] = (ProjectStatus.SUCCEEDED, None, None, None)
+
+    # Records a failure of the project. Re-raises it unless in keep-going mode
+    def record_failure(self, pr, e):
+        if not isinstance(e, (BuildError, ProjectSkipped)) and self.keep_going:
+            error = BuildError('{0}: {1}'.format(type(e).__name__, e))
+            error.__cause__ = e
+            e = error
+        if isinstance(e, ProjectSkipped):
+            out('Skipping project \'{0}\': {1}'.format(pr.proj_name, e))
+            result = (ProjectStatus.SKIPPED, None, str(e), None)
+        elif isinstance(e, BuildError) and self.keep_going:
+            out('ERROR: {0}'.format(e))
+            result = (ProjectStatus.FAILED, e.phase, str(e), e.log_file or pr.log_file)
+        else:
+            raise e
+        with self.lock:
+            self.results[pr.proj_name] = result
+
+    def run(self, pr, func):
+        try:
+            self.check_dependencies(pr)
+            func()
+        except Exception as e:
+            self.record_failure(pr, e)
+            return
+        self.record_success(pr)
+
+    def has_failures(self):
+        return any(r[0] != ProjectStatus.SUCCEEDED for r in self.results.values())
+
+    def print_summary(self):
+        rows = [('Project', 'Status', 'Phase', 'Log / reason')]
+        for proj_name, (status, phase, message, log_file) in self.results.items():
+            details = ''
+            if status == ProjectStatus.FAILED:
+                details = log_file
+            elif status == ProjectStatus.SKIPPED:
+                details = message
+            rows.append((proj_name, status.name.lower(), phase or '', details or ''))
+
+        widths = [max(len(row[i]) for row in rows) for i in range(3)]
+        out('')
+        out('Summary:')
+        for row in rows:
+            out(('  '.join(cell.ljust(width) for cell, width in zip(row, widths)) +
+                 '  ' + row[3]).rstrip())
+
+
 class Action(enum.Enum):
     CLEAN = 1
     FULL_CLEAN = 2
@@ -976,6 +4221,482 @@ class PbuilderAction(enum.Enum):
     UPDATE = 2
 
 
+# Returns the path of the file that records when the pbuilder base tarball has
+# been created or updated last
+def get_pbuilder_stamp_path(pbuilder_tgz):
+    return pbuilder_tgz + '.updated'
+
+
+def write_pbuilder_stamp(pbuilder_tgz):
+    with open(get_pbuilder_stamp_path(pbuilder_tgz), 'w') as f:
+        f.write('{0}\n'.format(time.time()))
+
+
+# Returns the time of the last creation or update of the pbuilder base
+# tarball or None if it does not exist. Falls back to the modification time of
+# the tarball if it has not been updated by make_all yet.
+def get_pbuilder_update_time(pbuilder_tgz):
+    if not os.path.isfile(pbuilder_tgz):
+        return None
+    try:
+        with open(get_pbuilder_stamp_path(pbuilder_tgz)) as f:
+            return float(f.read().strip())
+    except (OSError, ValueError):
+        return os.path.getmtime(pbuilder_tgz)
+
+
+# Creates or updates the pbuilder environment selected by paths
+def run_pbuilder_action(paths, pbuilder_action):
+    os.makedirs(paths.pbuilder_tgz_path, exist_ok=True)
+    os.makedirs(paths.pbuilder_workdir_path, exist_ok=True)
+    os.makedirs(paths.pbuilder_cache_path, exist_ok=True)
+    os.makedirs(paths.build_pbuilder_path, exist_ok=True)
+
+    actions = {
+        PbuilderAction.CREATE: 'create',
+        PbuilderAction.UPDATE: 'update'
+    }
+
+    # Note: on distributions that don't ship i386 aptitude the following needs to be added
+    # to /etc/pbuilderrc:
+    # PBUILDERSATISFYDEPENDSCMD=/usr/lib/pbuilder/pbuilder-satisfydepends-apt
+    sh(['sudo', 'pbuilder', actions[pbuilder_action],
+        '--distribution', paths.dist_distribution,
+        '--debootstrapopts', '--variant=buildd',
+        '--debootstrapopts', '--keyring',
+        '--debootstrapopts', paths.pbuilder_keyring,
+        '--buildplace', paths.pbuilder_workdir_path,
+        '--basetgz', paths.pbuilder_tgz,
+        '--architecture', paths.arch,
+        '--mirror', paths.pbuilder_mirror,
+        ] + get_pbuilder_othermirror_opt(paths.pbuilder_othermirror) + [
+        '--aptcache', paths.pbuilder_cache_path,
+        '--components', " ".join(paths.pbuilder_components)], cwd=paths.build_pbuilder_path)
+
+    if pbuilder_action == PbuilderAction.CREATE and "-backports" in paths.dist_suite:
+        with tempfile.NamedTemporaryFile() as f:
+            lines = [
+                '#!/bin/bash',
+                'echo "Package: *" >> /etc/apt/preferences',
+                f'echo "Pin: release a={paths.dist_suite}" >> /etc/apt/preferences',
+                'echo "Pin-Priority: 500" >> /etc/apt/preferences',
+            ]
+            text = '\n'.join(lines)
+            f.write(text.encode("utf-8"))
+            f.flush()
+            os.chmod(f.name, 0o555)
+            sh(['sudo', 'pbuilder', "execute",
+                '--basetgz', paths.pbuilder_tgz,
+                '--architecture', paths.arch,
+                "--save-after-exec",
+                f.name], cwd=paths.build_pbuilder_path)
+
+    write_pbuilder_stamp(paths.pbuilder_tgz)
+
+
+# Returns the PathConfs of all pbuilder environments in pbuilder_tgz_path
+def get_all_pbuilder_paths(paths):
+    pbuilder_paths = []
+    for path in sorted(glob.glob(os.path.join(paths.pbuilder_tgz_path, 'base_*.tgz'))):
+        m = re.match(r'^base_(.+)-([^-]+)\.tgz$', os.path.basename(path))
+        if m:
+            pbuilder_paths.append(paths.for_pbuilder_dist(m.group(1), m.group(2)))
+    return pbuilder_paths
+
+
+# Returns the PathConfs whose pbuilder environments have not been updated for
+# longer than max_age_days
+def get_stale_pbuilder_paths(pbuilder_paths, max_age_days):
+    stale_paths = []
+    for paths in pbuilder_paths:
+        update_time = get_pbuilder_update_time(paths.pbuilder_tgz)
+        if update_time is not None and time.time() - update_time > max_age_days * 86400:
+            stale_paths.append(paths)
+    return stale_paths
+
+
+# Updates the pbuilder environments of the given PathConfs, at most jobs of
+# them at a time
+def update_pbuilders(pbuilder_paths, jobs):
+    def update(paths):
+        name = '{0}-{1}'.format(paths.dist_suite, paths.arch)
+        with command_context('pbuilder', name):
+            out("Updating pbuilder environment {0}".format(name))
+            try:
+                run_pbuilder_action(paths, PbuilderAction.UPDATE)
+            except BuildError as e:
+                out("ERROR: Updating pbuilder environment {0} failed: {1}".format(name, e))
+                return False
+            return True
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = list(executor.map(update, pbuilder_paths))
+    failed_count = results.count(False)
+    if failed_count > 0:
+        raise BuildError('Failed to update {0} pbuilder environments'.format(failed_count))
+
+
+def publish_package(pr, job, action):
+    # Packages for multiple architectures are all published, but only those of
+    # the host architecture are installed into the system
+    pkgver_paths = None
+    if job.arch_result_paths:
+        pkgver_paths = [job.arch_result_paths[arch] for arch in job.arches]
+
+    if pr.build_pkgver_path is not None:
+        for pkgver_path in pkgver_paths or [pr.build_pkgver_path]:
+            pr.write_manifest(pkgver_path)
+        pr.write_latest(pkgver_paths or [pr.build_pkgver_path], pr.build_pkgver_path)
+
+    key = get_config_debian_sign_key(pr.config, pr.proj_name)
+    signing_queue = pr.paths.signing_queue
+    if key is not None and signing_queue is not None:
+        result_paths = set(pkgver_paths or [pr.build_pkgver_path]) | {job.result_path}
+        for result_path in sorted(p for p in result_paths if p is not None and os.path.isdir(p)):
+            for fn in sorted(os.listdir(result_path)):
+                if fn.endswith('.changes'):
+                    signing_queue.add(pr, key, os.path.join(result_path, fn))
+
+    if action in [Action.PACKAGE, Action.PACKAGE_SOURCE]:
+        if not job.pristine:
+            for pkgver_path in pkgver_paths or [pr.build_pkgver_path]:
+                out('Packages placed in: ' + pkgver_path)
+    elif pr.is_phase_done(job, PackagePhase.PUBLISH):
+        out("Project \'{0}\' has already been installed".format(pr.proj_name))
+    elif action == Action.INSTALL:
+        out("Installing project: \'{0}\'".format(pr.proj_name))
+        pr.install()
+        pr.debinstall(pkgver_paths)
+    elif action == Action.DEBINSTALL:
+        out("Installing project: \'{0}\'".format(pr.proj_name))
+        pr.debinstall(pkgver_paths)
+    pr.record_phase(job, PackagePhase.PUBLISH)
+
+
+# Runs the package stages of each (project, job) item. If pipelined is set,
+# each stage runs in a thread of its own, so that the stages of different
+# projects overlap.
+def run_package_jobs(jobs, action, runner, pipelined=False):
+    def make_stage_func(stage):
+        def stage_func(item):
+            pr, job = item
+            try:
+                runner.check_dependencies(pr)
+            except ProjectSkipped:
+                pr.abort_staging(job)
+                raise
+            if stage == PackageStage.PUBLISH:
+                with pr.phase_context('publish'):
+                    publish_package(pr, job, action)
+                runner.record_success(pr)
+            else:
+                pr.run_package_stage(job, stage)
+        return stage_func
+
+    stages = [(stage.name.lower(), make_stage_func(stage)) for stage in PackageStage]
+    if pipelined:
+        Pipeline(stages, on_error=lambda item, e: runner.record_failure(item[0], e)).run(jobs)
+        return
+
+    for item in jobs:
+        try:
+            for _, stage_func in stages:
+                stage_func(item)
+        except Exception as e:
+            runner.record_failure(item[0], e)
+
+
+# Options of the actions run by run_action(). See the command line options of
+# main() for their meaning.
+class ActionOptions:
+
+    def __init__(self, pristine=False, pristine_bare=False, use_dist=False, use_pbuilder=False,
+                 pbuilder_profiles=None, arch=None, arches=None, use_cache=True,
+                 fast_compression=False, resume=False, keep_going=False, do_build=False,
+                 do_check=False, local_repo=None):
+        self.pristine = pristine or pristine_bare
+        self.pristine_bare = pristine_bare
+        self.use_dist = use_dist
+        self.use_pbuilder = use_pbuilder
+        self.pbuilder_profiles = pbuilder_profiles
+        self.arch = arch
+        # See PackageJob.arches
+        self.arches = arches
+        self.use_cache = use_cache
+        self.fast_compression = fast_compression
+        self.resume = resume
+        self.keep_going = keep_going
+        self.do_build = do_build
+        self.do_check = do_check
+        # None, 'archive' or 'run'. See LocalRepository
+        self.local_repo = local_repo
+
+
+# Raises BuildError if the options can't be used with the action
+def check_action_options(action, options):
+    package_actions = [Action.PACKAGE, Action.PACKAGE_SOURCE, Action.INSTALL, Action.DEBINSTALL]
+
+    if options.arches is not None and \
+            (options.pristine or action not in [Action.PACKAGE, Action.INSTALL,
+                                                Action.DEBINSTALL]):
+        raise BuildError("Multiple architectures can only be used along with --package, "
+                         "--install and --debinstall without --pristine")
+
+    if options.fast_compression and action == Action.PACKAGE_SOURCE:
+        raise BuildError("--fast-compression must not be used along with --package-source")
+
+    if options.pristine and action in [Action.CLEAN, Action.FULL_CLEAN, Action.BUILD]:
+        raise BuildError("--pristine and --pristine_bare must not be used along with --clean, "
+                         "--full_clean and --build")
+
+    if options.resume and action not in package_actions:
+        raise BuildError("--resume can only be used when packaging")
+
+    if options.local_repo not in [None, 'archive', 'run']:
+        raise BuildError("Unsupported local repository mode {0}".format(options.local_repo))
+    if options.local_repo is not None and not options.use_pbuilder:
+        raise BuildError("--local-repo can only be used along with --use-pbuilder")
+
+
+# Returns the Projects with the given names. A name may be prefixed with the
+# directory of the project within the root path, e.g. checkouts/name. The name
+# . refers to the project in the current directory. Raises BuildError if no
+# project is found.
+def find_projects(paths, names):
+    checked_projects = []
+
+    for proj in names:
+        if proj == '.':
+            cwd = os.getcwd()
+            proj = os.path.basename(cwd)
+            checked_projects.append((cwd, proj))
+            if os.path.dirname(os.path.dirname(cwd)) != paths.root_path:
+                raise BuildError(". project name can only be used in project root")
+            continue
+
+        if '/' in proj:
+            project_root, proj = proj.split('/')
+            project_dirs = [os.path.join(paths.root_path, project_root)]
+        else:
+            project_dirs = paths.project_dirs
+        available_projects = get_available_projects(project_dirs)
+        for d, p in available_projects:
+            if p == proj:
+                checked_projects += [(d, p)]
+                break
+
+    for path in paths.build_path, paths.build_pkg_path:
+        os.makedirs(path, exist_ok=True)
+
+    if len(checked_projects) == 0:
+        raise BuildError("Project not found. Abort. ")
+
+    out("Found projects: ")
+    for d, p in checked_projects:
+        out('\'{0}\' in directory \'{1}\''.format(p, d))
+    return [Project(paths, p, d) for d, p in checked_projects]
+
+
+# Returns the projects that have changed since their last successful build
+# together with all projects that build-depend on them directly or indirectly.
+# Each project comes after the projects it build-depends on.
+def find_changed_projects(paths, pristine, bare=False, use_dist=False):
+    projects = [Project(paths, p, d) for d, p in get_available_projects(paths.project_dirs)]
+    records = BuildRecords(paths.build_records_path)
+
+    selected = set()
+    for pr in projects:
+        fingerprint = pr.get_build_record_fingerprint(pristine=pristine, bare=bare,
+                                                      use_dist=use_dist)
+        if records.is_changed(pr.get_build_record_key(), fingerprint):
+            out('Project \'{0}\' has changed'.format(pr.proj_name))
+            selected.add(pr.proj_name)
+
+    dependencies = get_project_dependencies(projects, pristine)
+    reverse_dependencies = {}
+    for proj_name, deps in dependencies.items():
+        for dep in deps:
+            reverse_dependencies.setdefault(dep, set()).add(proj_name)
+
+    pending = sorted(selected)
+    while pending:
+        dep = pending.pop()
+        for proj_name in sorted(reverse_dependencies.get(dep, ())):
+            if proj_name not in selected:
+                out('Project \'{0}\' build-depends on \'{1}\''.format(proj_name, dep))
+                selected.add(proj_name)
+                pending.append(proj_name)
+
+    ordered = [pr for pr in sort_projects(projects, dependencies) if pr.proj_name in selected]
+
+    for path in paths.build_path, paths.build_pkg_path:
+        os.makedirs(path, exist_ok=True)
+
+    if ordered:
+        out("Changed projects and their reverse dependencies: ")
+        for pr in ordered:
+            out('\'{0}\' in directory \'{1}\''.format(pr.proj_name, pr.code_path))
+    else:
+        out('No projects have changed since their last successful build')
+    return ordered
+
+
+# Runs the action for the given projects. Raises BuildError on failure unless
+# options.keep_going is set. Returns the BatchRunner with the outcome of each
+# project.
+def run_action(paths, projects, action, options):
+    check_action_options(action, options)
+    pristine = options.pristine
+
+    runner = BatchRunner(keep_going=options.keep_going)
+    if options.keep_going:
+        # Dependencies are built first, so that the projects depending on a
+        # failed one are skipped
+        dependencies = get_project_dependencies(projects, pristine)
+        runner.set_dependencies(dependencies)
+        projects = sort_projects(projects, dependencies)
+
+    # The inputs are fingerprinted before the build so that changes made
+    # while it runs are picked up by the next --changed run
+    fingerprints = {}
+    if action in [Action.PACKAGE, Action.INSTALL, Action.DEBINSTALL]:
+        fingerprints = {
+            pr.proj_name: pr.get_build_record_fingerprint(
+                pristine=pristine, bare=options.pristine_bare, use_dist=options.use_dist)
+            for pr in projects
+        }
+
+    if options.local_repo is not None:
+        paths.local_repo = LocalRepository(paths, options.local_repo)
+    paths.signing_queue = SigningQueue()
+    signed = False
+    try:
+        run_action_impl(paths, projects, action, options, runner)
+    finally:
+        try:
+            # The packages published before a failure are signed too
+            paths.signing_queue.sign_all()
+            signed = True
+        finally:
+            paths.signing_queue = None
+            paths.gc = None
+            if paths.local_repo is not None:
+                paths.local_repo.remove()
+                paths.local_repo = None
+
+            # Unsigned packages are rebuilt by the next --changed run
+            if signed:
+                records = BuildRecords(paths.build_records_path)
+                for pr in projects:
+                    result = runner.results.get(pr.proj_name, None)
+                    if pr.proj_name in fingerprints and result is not None and \
+                            result[0] == ProjectStatus.SUCCEEDED:
+                        records.record(pr.get_build_record_key(), fingerprints[pr.proj_name])
+    return runner
+
+
+def run_action_impl(paths, projects, action, options, runner):
+    config = paths.config
+    pristine = options.pristine
+    use_pbuilder = options.use_pbuilder
+    pbuilder_profiles = options.pbuilder_profiles
+
+    pbuilder_actions = [Action.PACKAGE, Action.INSTALL, Action.DEBINSTALL]
+    if pristine:
+        pbuilder_actions.append(Action.PACKAGE_SOURCE)
+
+    # Stale pbuilder environments are updated before they are used
+    pbuilder_max_age_days = config.get('pbuilder_max_age_days', None)
+    if use_pbuilder and action in pbuilder_actions and pbuilder_max_age_days is not None:
+        stale_paths = get_stale_pbuilder_paths(
+            [paths.for_pbuilder_dist(paths.dist_suite, arch)
+             for arch in options.arches or [paths.arch]],
+            pbuilder_max_age_days)
+        if stale_paths:
+            update_pbuilders(stale_paths, config.get('pbuilder_update_jobs', 2))
+
+    # Build dependencies of all projects are downloaded while the first
+    # projects are being built
+    if use_pbuilder and action in pbuilder_actions and \
+            os.path.isfile(paths.pbuilder_tgz) and shutil.which('apt-get') is not None:
+        build_depends = []
+        for pr in projects:
+            if get_config_prefetch_build_depends(pr.config, pr.proj_name):
+                build_depends += pr.get_pbuilder_build_depends(pristine, pbuilder_profiles)
+        prefetcher = BuildDependsPrefetcher(paths, config.get('prefetch_jobs', 8))
+        prefetcher.start(build_depends)
+
+    # Old packaging build directories are removed while the builds proceed
+    gc = GarbageCollector.from_config(paths)
+    run_gc = gc.has_policies() and action in [Action.PACKAGE, Action.PACKAGE_SOURCE,
+                                              Action.INSTALL, Action.DEBINSTALL]
+    if run_gc:
+        paths.gc = gc
+        gc.start()
+
+    # do work
+    if action == Action.FULL_CLEAN:
+        for pr in projects:
+            runner.run(pr, lambda: (pr.reconf(), pr.clean()))
+
+    elif action == Action.CLEAN:
+        for pr in projects:
+            runner.run(pr, pr.clean)
+
+    elif action == Action.BUILD:
+        for pr in projects:
+            runner.run(pr, lambda: (pr.build(), pr.check_build(options.do_check)))
+
+    elif action in [Action.PACKAGE, Action.PACKAGE_SOURCE, Action.INSTALL, Action.DEBINSTALL]:
+        do_source = action == Action.PACKAGE_SOURCE
+        dependency_fingerprints = {}
+        if options.use_cache:
+            dependency_fingerprints = get_dependency_fingerprints(paths, projects, options)
+        jobs = []
+        for pr in projects:
+            if pristine:
+                job = PackageJob(pristine=True, bare=options.pristine_bare, do_source=do_source,
+                                 use_pbuilder=use_pbuilder,
+                                 pbuilder_profiles=None if do_source else pbuilder_profiles,
+                                 use_cache=options.use_cache,
+                                 fast_compression=options.fast_compression,
+                                 resume=options.resume, action=action)
+            else:
+                # --debinstall always builds the source tree
+                job = PackageJob(do_source=do_source, do_check=options.do_check,
+                                 use_dist=options.use_dist,
+                                 use_pbuilder=use_pbuilder and not do_source, arch=options.arch,
+                                 arches=options.arches,
+                                 pbuilder_profiles=None if do_source else pbuilder_profiles,
+                                 use_cache=options.use_cache,
+                                 do_build=options.do_build or action == Action.DEBINSTALL,
+                                 do_check_build=options.do_check,
+                                 fast_compression=options.fast_compression,
+                                 resume=options.resume, action=action)
+            job.dependency_fingerprints = dependency_fingerprints.get(pr.proj_name, None)
+            jobs.append((pr, job))
+
+        # Binary packages are built in pbuilder chroots, so the next project
+        # can be prepared on the host in the meantime
+        run_package_jobs(jobs, action, runner, pipelined=use_pbuilder)
+
+    elif action == Action.REINSTALL:
+        for pr in projects:
+            out("Installing project: \'{0}\'".format(pr.proj_name))
+            runner.run(pr, lambda: (pr.install(), pr.debinstall()))
+
+    elif action == Action.DEBREINSTALL:
+        for pr in projects:
+            out("Installing project: \'{0}\'".format(pr.proj_name))
+            runner.run(pr, pr.debinstall)
+
+    else:
+        raise BuildError("Wrong action! \'{0}\'".format(action))
+
+    if run_gc:
+        gc.join()
+
+
 def main():
     paths = PathConf()
 
@@ -1020,7 +4741,9 @@ def main():
                         help='Build distributable package using make dist or equivalent when ' +
                         'packaging')
     parser.add_argument('--arch', type=str, default=None,
-                        help='Override the architecture for packaging')
+                        help='Override the architecture for packaging. A comma-separated list ' +
+                        'of architectures builds the source package once and the binary ' +
+                        'packages for all of them concurrently')
     parser.add_argument('--debreinstall', action='store_true', default=False,
                         help='Reinstalls most recently built binary packages to the local ' +
                         'repository')
@@ -1043,10 +4766,45 @@ def main():
     parser.add_argument('--update-pbuilder', action='store_true', default=False,
                         help='Updates a pbuilder environment. Must not be used with any other ' +
                         'build-related option. --pbuilder-dist selects the distribution')
+    parser.add_argument('--update-all-pbuilders', action='store_true', default=False,
+                        help='Updates all pbuilder environments, pbuilder_update_jobs of them at ' +
+                        'a time. Must not be used with any other build-related option')
+    parser.add_argument('--local-repo', choices=['archive', 'run'], default=None,
+                        help='Makes packages available to pbuilder builds as a repository that ' +
+                        'takes precedence over the distribution. \'archive\' uses the ' +
+                        'packages in the local repository, \'run\' the packages built ' +
+                        'earlier in the same run, so that dependency chains can be built in ' +
+                        'one go. Can only be used with --use-pbuilder')
     parser.add_argument('--pbuilder-profiles', type=str, default=None,
                         help='Selects profiles to pass to pbuilder')
     parser.add_argument('--pbuilder-dist', type=str, default=None,
                         help='Selects the pbuilder distribution')
+    parser.add_argument('--no-artifact-cache', action='store_true', default=False,
+                        help='Always build packages even if an earlier build with identical ' +
+                        'inputs has succeeded')
+    parser.add_argument('--fast-compression', action='store_true', default=False,
+                        help='Compresses orig tarballs and binary packages with a fast setting. ' +
+                        'Intended for packages that only go to the local repository. Must not be ' +
+                        'used with --package-source')
+    parser.add_argument('--keep-going', action='store_true', default=False,
+                        help='Continues with the remaining projects when a project fails. ' +
+                        'Projects that build-depend on a failed project are skipped. A summary ' +
+                        'is printed at the end')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='Skips the packaging phases that have completed in an earlier run ' +
+                        'with identical inputs, e.g. to retry a build that failed in the ' +
+                        'pbuilder chroot without recreating the source package. The build ' +
+                        'directories of failed builds on the tmpfs are only kept for a later ' +
+                        'resume if this is given')
+    parser.add_argument('--changed', action='store_true', default=False,
+                        help='Selects the projects whose sources or packaging have changed ' +
+                        'since their last successful package build, together with the ' +
+                        'projects that build-depend on them. Must not be used with project ' +
+                        'names')
+    parser.add_argument('--gc', action='store_true', default=False,
+                        help='Removes old packaging build directories and artifact cache entries ' +
+                        'according to the gc_* retention policies in the config. Must not be ' +
+                        'used with any other build-related option')
     args = parser.parse_args()
 
     if args.build:
@@ -1085,206 +4843,95 @@ def main():
         pbuilder_action = PbuilderAction.CREATE
     elif args.update_pbuilder:
         pbuilder_action = PbuilderAction.UPDATE
-    pbuilder_profiles = args.pbuilder_profiles
+
+    arches = None
+    arch = args.arch
+    if arch is not None and ',' in arch:
+        arches = [a for a in arch.split(',') if a]
+        arch = None
 
     if args.pbuilder_dist is not None:
-        paths.set_pbuilder_dist(args.pbuilder_dist, args.arch)
+        paths.set_pbuilder_dist(args.pbuilder_dist, arch)
 
     if pbuilder_action is not None:
-        if pristine or pristine_bare or action is not None:
+        if pristine or pristine_bare or action is not None or args.update_all_pbuilders:
             out("ERROR: --create-pbuilder must not be used along with any "
                 "other options")
             sys.exit(1)
+        if arches is not None:
+            out("ERROR: --create-pbuilder takes a single architecture")
+            sys.exit(1)
         out("Creating pbuilder environment. Please wait...")
-
-        os.makedirs(paths.pbuilder_tgz_path, exist_ok=True)
-        os.makedirs(paths.pbuilder_workdir_path, exist_ok=True)
-        os.makedirs(paths.pbuilder_cache_path, exist_ok=True)
-        os.makedirs(paths.build_pbuilder_path, exist_ok=True)
-
-        actions = {
-            PbuilderAction.CREATE: 'create',
-            PbuilderAction.UPDATE: 'update'
-        }
-
-        # Note: on distributions that don't ship i386 aptitude the following needs to be added
-        # to /etc/pbuilderrc:
-        # PBUILDERSATISFYDEPENDSCMD=/usr/lib/pbuilder/pbuilder-satisfydepends-apt
-        sh(['sudo', 'pbuilder', actions[pbuilder_action],
-            '--distribution', paths.dist_distribution,
-            '--debootstrapopts', '--variant=buildd',
-            '--debootstrapopts', '--keyring',
-            '--debootstrapopts', paths.pbuilder_keyring,
-            '--buildplace', paths.pbuilder_workdir_path,
-            '--basetgz', paths.pbuilder_tgz,
-            '--architecture', paths.arch,
-            '--mirror', paths.pbuilder_mirror,
-            ] + get_pbuilder_othermirror_opt(paths.pbuilder_othermirror) + [
-            '--aptcache', paths.pbuilder_cache_path,
-            '--components', " ".join(paths.pbuilder_components)], cwd=paths.build_pbuilder_path)
-
-        if pbuilder_action == PbuilderAction.CREATE and "-backports" in paths.dist_suite:
-            with tempfile.NamedTemporaryFile() as f:
-                lines = [
-                    '#!/bin/bash',
-                    'echo "Package: *" >> /etc/apt/preferences',
-                    f'echo "Pin: release a={paths.dist_suite}" >> /etc/apt/preferences',
-                    'echo "Pin-Priority: 500" >> /etc/apt/preferences',
-                ]
-                text = '\n'.join(lines)
-                f.write(text.encode("utf-8"))
-                f.flush()
-                os.chmod(f.name, 0o555)
-                sh(['sudo', 'pbuilder', "execute",
-                    '--basetgz', paths.pbuilder_tgz,
-                    '--architecture', paths.arch,
-                    "--save-after-exec",
-                    f.name], cwd=paths.build_pbuilder_path)
-
+        run_pbuilder_action(paths, pbuilder_action)
         sys.exit(0)
 
-    if pristine:
-        if action in [Action.CLEAN, Action.FULL_CLEAN, Action.BUILD]:
-            out("ERROR: --pristine and --pristine_bare must not be used along with --clean, "
-                "--full_clean and --build")
+    if args.update_all_pbuilders:
+        if pristine or action is not None:
+            out("ERROR: --update-all-pbuilders must not be used along with any other options")
             sys.exit(1)
-        paths.project_dirs = paths.deb_project_dirs
-        paths.build_pkg_path = paths.build_deb_pkg_path
-
-    # check received projects
-    checked_projects = []
-
-    for proj in args.projects:
-        if proj == '.':
-            cwd = os.getcwd()
-            proj = os.path.basename(cwd)
-            checked_projects.append((cwd, proj))
-            if os.path.dirname(os.path.dirname(cwd)) != paths.root_path:
-                out("ERROR: . project name can only be used in project root")
-                sys.exit(1)
-            continue
-
-        if '/' in proj:
-            project_root, proj = proj.split('/')
-            project_dirs = [os.path.join(paths.root_path, project_root)]
-        else:
-            project_dirs = paths.project_dirs
-        available_projects = get_available_projects(project_dirs)
-        for d, p in available_projects:
-            if p == proj:
-                checked_projects += [(d, p)]
-                break
-
-    for path in paths.build_path, paths.build_pkg_path:
-        os.makedirs(path, exist_ok=True)
+        pbuilder_paths = get_all_pbuilder_paths(paths)
+        if not pbuilder_paths:
+            out("ERROR: No pbuilder environments in {0}".format(paths.pbuilder_tgz_path))
+            sys.exit(1)
+        update_pbuilders(pbuilder_paths, paths.config.get('pbuilder_update_jobs', 2))
+        sys.exit(0)
 
-    if len(checked_projects) > 0:
-        out("Found projects: ")
-        for d, p in checked_projects:
-            out('\'{0}\' in directory \'{1}\''.format(p, d))
-    else:
-        out("ERROR: Project not found. Abort. ")
-        sys.exit(1)
+    if args.gc:
+        if pristine or action is not None:
+            out("ERROR: --gc must not be used along with any other options")
+            sys.exit(1)
+        gc = GarbageCollector.from_config(paths)
+        if not gc.has_policies():
+            out("ERROR: No gc_* retention policies are configured")
+            sys.exit(1)
+        gc.run()
+        gc.report()
+        sys.exit(0)
 
     if action is None:
         out("WARN: Action not specified. Defaulting to compile+package+install")
         action = Action.INSTALL
 
-    # do work
-    if action == Action.FULL_CLEAN:
-        for d, p in checked_projects:
-            pr = Project(paths, p, d)
-            pr.reconf()
-            pr.clean()
+    options = ActionOptions(pristine=pristine, pristine_bare=pristine_bare, use_dist=use_dist,
+                            use_pbuilder=use_pbuilder, pbuilder_profiles=args.pbuilder_profiles,
+                            arch=arch, arches=arches, use_cache=not args.no_artifact_cache,
+                            fast_compression=args.fast_compression, resume=args.resume,
+                            keep_going=args.keep_going, do_build=do_build, do_check=do_check,
+                            local_repo=args.local_repo)
+    check_action_options(action, options)
 
-    elif action == Action.CLEAN:
-        for d, p in checked_projects:
-            pr = Project(paths, p, d)
-            pr.clean()
-
-    elif action == Action.BUILD:
-        for d, p in checked_projects:
-            pr = Project(paths, p, d)
-            pr.build()
-            pr.check_build(do_check)
-
-    elif action == Action.PACKAGE:
-        for d, p in checked_projects:
-            pr = Project(paths, p, d)
-            if pristine:
-                pr.package_pristine(use_pbuilder=use_pbuilder, bare=pristine_bare,
-                                    pbuilder_profiles=pbuilder_profiles)
-            else:
-                pr.build(do_build)
-                pr.check_build(do_build and do_check)
-                pr.package(do_check=do_check, use_dist=use_dist, use_pbuilder=use_pbuilder,
-                           arch=args.arch, pbuilder_profiles=pbuilder_profiles)
-                out('Packages placed in: ' + pr.build_pkgver_path)
-
-    elif action == Action.PACKAGE_SOURCE:
-        for d, p in checked_projects:
-            pr = Project(paths, p, d)
-            if pristine:
-                pr.package_pristine(do_source=True, use_pbuilder=use_pbuilder, bare=pristine_bare)
-            else:
-                pr.build(do_build)
-                pr.check_build(do_build and do_check)
-                pr.package(do_source=True, do_check=do_check, use_dist=use_dist,
-                           arch=args.arch)
-                out('Packages placed in: ' + pr.build_pkgver_path)
-
-    elif action == Action.INSTALL:
-        for d, p in checked_projects:
-            pr = Project(paths, p, d)
-
-            if pristine:
-                pr.package_pristine(use_pbuilder=use_pbuilder, bare=pristine_bare,
-                                    pbuilder_profiles=pbuilder_profiles)
-            else:
-                pr.build(do_build)
-                pr.check_build(do_build and do_check)
-                pr.package(do_check=do_check, use_dist=use_dist, use_pbuilder=use_pbuilder,
-                           arch=args.arch, pbuilder_profiles=pbuilder_profiles)
-
-            out("Installing project: \'{0}\'".format(p))
-            pr.install()
-            pr.debinstall()
-
-    elif action == Action.REINSTALL:
-        for d, p in checked_projects:
-            pr = Project(paths, p, d)
-            out("Installing project: \'{0}\'".format(p))
-            pr.install()
-            pr.debinstall()
-
-    elif action == Action.DEBINSTALL:
-        for d, p in checked_projects:
-            pr = Project(paths, p, d)
-
-            if pristine:
-                pr.package_pristine(use_pbuilder=use_pbuilder, bare=pristine_bare,
-                                    pbuilder_profiles=pbuilder_profiles)
-            else:
-                pr.build()
-                pr.check_build(do_check)
-                pr.package(do_check=do_check, use_dist=use_dist, use_pbuilder=use_pbuilder,
-                           arch=args.arch, pbuilder_profiles=pbuilder_profiles)
-
-            out("Installing project: \'{0}\'".format(p))
-            pr.debinstall()
+    if pristine:
+        paths.set_pristine()
+    if args.changed:
+        if args.projects:
+            out('ERROR: --changed must not be used with project names')
+            sys.exit(1)
+        projects = find_changed_projects(paths, pristine, bare=pristine_bare,
+                                         use_dist=use_dist)
+        if not projects:
+            sys.exit(0)
+    else:
+        projects = find_projects(paths, args.projects)
+    runner = run_action(paths, projects, action, options)
 
-    elif action == Action.DEBREINSTALL:
-        for d, p in checked_projects:
-            pr = Project(paths, p, d)
-            out("Installing project: \'{0}\'".format(p))
-            pr.debinstall()
+    engine = get_command_engine()
+    if engine.accounting.has_usage():
+        engine.accounting.print_summary()
 
-    else:
-        out("ERROR: Wrong action! \'{0}\'".format(action))
-        sys.exit(1)
+    if args.keep_going:
+        runner.print_summary()
+        if runner.has_failures():
+            sys.exit(1)
 
     out("Success!")
 
 
 if __name__ == '__main__':
-    main()
+    try:
+        main()
+    except BuildError as e:
+        out('ERROR: {0}'.format(e))
+        sys.exit(e.get_exit_code())
+    except KeyboardInterrupt:
+        get_command_engine().cancel_all()
+        sys.exit(130)